@@ -1,56 +1,385 @@
 import sys
+import time
 from datetime import date, datetime, timedelta, timezone
+from typing import TYPE_CHECKING
 
+import numpy as np
 import orjson
-import pandas as pd
-from pandas.api.types import is_numeric_dtype
-from flask import g, Response, request, jsonify
+import pyarrow as pa
+import pyarrow.compute as pc
+from flask import abort, g, Response, request, jsonify, redirect, send_file, url_for
 from flask.blueprints import Blueprint
+from werkzeug.exceptions import BadRequest
+from werkzeug.wrappers import Response as WerkzeugResponse
 
-from . import queries
+from . import compression, export, metrics, queries
+
+# pandas takes about as long to import as everything else, and is only used for responses
+# from DuckDB when there is no columnar store
+if TYPE_CHECKING:
+    import pandas as pd
 
 app = Blueprint("api", __name__)
 
+# Part of every version the API serves, along with the data version. Bump it when the shape
+# of a response changes, so responses cached as immutable with the old shape are not reused
+API_REVISION = 1
+
+
+def revised(versions: dict[date | None, str]) -> dict[date | None, str]:
+    """The data versions from queries.data_versions, with API_REVISION mixed in"""
+    return {key: f"r{API_REVISION}-{version}" for key, version in versions.items()}
+
+
+# Endpoints whose responses do not only depend on the data
+_unversioned = {"stats", "readycheck"}
+# Clients should find out about new data versions quickly
+_short_lived = {"partitions"}
+
+
+@app.url_value_preprocessor
+def pop_version(_endpoint: str | None, values: dict[str, object] | None):
+    g.requested_version = values.pop("version", None) if values else None
+
+
+def _endpoint() -> str:
+    # The blueprint is registered both as api and versioned_api
+    return (request.endpoint or "").split(".")[-1]
+
+
+def data_version() -> str | None:
+    """The version of the data behind this response, see etl.mkdb._data_version
+
+    Months have their own versions, so closed months keep theirs when new data arrives.
+    Comparisons join the versions of the current and previous month with a dot.
+    """
+    args = request.view_args or {}
+    if _endpoint() in _unversioned:
+        return None
+    elif "cur_year" in args:
+        cur = g.versions.get(date(args["cur_year"], args["cur_month"], 1))
+        prev = g.versions.get(date(args["prev_year"], args["prev_month"], 1))
+        return f"{cur}.{prev}" if cur and prev else None
+    elif "year" in args:
+        return g.versions.get(date(args["year"], args["month"], 1))
+    else:
+        return g.versions.get(None)
+
+
+def etag(version: str, encoding: str | None) -> str:
+    """The ETag of a response with a data version, each encoding of its body has its own"""
+    return version if encoding is None else f"{version}-{encoding}"
+
+
+@app.before_request
+def check_version() -> WerkzeugResponse | None:
+    g.version = data_version() if request.endpoint is not None else None
+    accepted = {value.lower(): quality for value, quality in request.accept_encodings}
+    g.encoding = compression.negotiate(accepted)
+    if g.version is None or request.endpoint is None:
+        return None
+    elif g.requested_version is not None and g.requested_version != g.version:
+        # The same url with the current version in place of the requested one, and the
+        # query string as it came
+        location = url_for(request.endpoint, version=g.version, **(request.view_args or {}))
+        if request.query_string:
+            location += "?" + request.query_string.decode("latin-1")
+        return redirect(location)
+    # Small bodies are not compressed, so the client may have the plain one
+    for tag in (etag(g.version, g.encoding), g.version):
+        if tag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(tag)
+            return response
+    return None
+
+
+def _cache_key(encoding: str) -> tuple[object, ...]:
+    args = tuple(sorted((request.view_args or {}).items()))
+    return _endpoint(), args, request.query_string, g.version, encoding
+
+
+@app.before_request
+def cached_response() -> Response | None:
+    """The compressed body of this response, if it was made and cached before
+
+    Only responses with a data version are cached, since they do not change.
+    """
+    if g.responses is None or g.version is None or g.encoding is None:
+        return None
+    found = g.responses.get(_cache_key(g.encoding))
+    if found is None:
+        return None
+    body, content_type = found
+    response = Response(body, content_type=content_type)
+    response.headers["Content-Encoding"] = g.encoding
+    return response
+
+
+def _immutable(response: Response) -> bool:
+    # A url with the current data version always has the same response
+    return (
+        g.get("version") is not None
+        and g.get("requested_version") is not None
+        and response.status_code in (200, 304)
+    )
+
+
+def _max_age(response: Response) -> int:
+    if _immutable(response):
+        return 31536000
+    elif response.status_code == 302 or _endpoint() in _short_lived:
+        return 300
+    return 5400
+
+
+@app.errorhandler(queries.InvalidParameter)
+def invalid_parameter(e: queries.InvalidParameter) -> BadRequest:
+    return BadRequest(description=str(e))
+
 
 @app.after_request
 def set_headers(response: Response) -> Response:
     response.headers.add("Access-Control-Allow-Origin", "*")
     response.headers.add("Access-Control-Allow-Methods", "GET,OPTIONS")
-    response.headers["Cache-Control"] = "public, max-age=5400"
+    response.headers.add("Access-Control-Expose-Headers", "ETag, X-Data-Version")
+    max_age = _max_age(response)
+    response.headers["Cache-Control"] = f"public, max-age={max_age}" + (
+        ", immutable" if _immutable(response) else ""
+    )
     response.headers["Expires"] = (
-        datetime.now(timezone.utc) + timedelta(seconds=5400)
+        datetime.now(timezone.utc) + timedelta(seconds=max_age)
     ).strftime("%a, %d %b %Y %H:%M:%S GMT")
+    if (
+        g.get("version") is not None
+        and response.status_code in (200, 304)
+        and "ETag" not in response.headers
+    ):
+        response.set_etag(etag(g.version, response.headers.get("Content-Encoding")))
+    if g.versions.get(None) is not None:
+        response.headers["X-Data-Version"] = g.versions[None]
     response.headers.add("Vary", "line_ref")
     response.headers.add("Vary", "data_source")
+    response.headers.add("Vary", "Accept-Encoding")
     return response
 
 
-def to_json(df: pd.DataFrame) -> Response:
-    resp = orjson.dumps(
-        {
+@app.after_request
+def compress_response(response: Response) -> Response:
+    encoding = g.get("encoding")
+    if (
+        encoding is None
+        or response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    body = response.get_data()
+    if len(body) < compression.MIN_SIZE:
+        return response
+    response.set_data(compression.compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    if g.responses is not None and g.version is not None:
+        g.responses.put(_cache_key(encoding), response.get_data(), response.content_type)
+    return response
+
+
+def _arrow_columns(table: pa.Table) -> dict[str, object]:
+    return {
+        name: column.to_numpy()
+        if pa.types.is_integer(column.type) or pa.types.is_floating(column.type)
+        else column.to_pylist()
+        for name, column in zip(table.column_names, table.columns)
+    }
+
+
+# Stop coordinates in compact responses are integers, divide by 10 ** precision
+COORDINATE_PRECISION = 5
+
+_geometry_columns = [
+    "name",
+    "from_stop",
+    "to_stop",
+    "from_lat",
+    "from_lon",
+    "to_lat",
+    "to_lon",
+    "lat",
+    "lon",
+]
+
+
+def _compact_columns(table: pa.Table) -> dict[str, object]:
+    """Columns of table with each distinct stop sent once in a stop table
+
+    Rows refer to stops by index in from and to, name is from_stop + " to " + to_stop
+    and the label position lat/lon is from * .985 + to * .015, like in queries.legs.
+    """
+    scale = 10**COORDINATE_PRECISION
+
+    def both(start: str, end: str) -> pa.Array:
+        return pa.concat_arrays(
+            [table[start].combine_chunks(), table[end].combine_chunks()]
+        )
+
+    def quantize(start: str, end: str) -> np.ndarray:
+        coordinates = np.concatenate([table[start].to_numpy(), table[end].to_numpy()])
+        return np.rint(coordinates * scale).astype(np.int32)
+
+    names = pc.cast(both("from_stop", "to_stop"), pa.string())
+    lats = quantize("from_lat", "to_lat")
+    lons = quantize("from_lon", "to_lon")
+    # Prefix each name with its packed coordinates, so a stop is a (name, lat, lon)
+    coordinates = (lats.astype(np.int64) << 32) | (lons.astype(np.int64) & 0xFFFFFFFF)
+    packed = pa.Array.from_buffers(
+        pa.binary(8), len(coordinates), [None, pa.py_buffer(coordinates)]
+    )
+    keys = pc.binary_join_element_wise(  # pyright: ignore[reportAttributeAccessIssue]
+        pc.cast(packed, pa.binary()), pc.cast(names, pa.binary()), b""
+    )
+    codes = keys.dictionary_encode().indices.to_numpy()
+    # Codes are handed out in order of appearance, so a stop first appears where its
+    # code is larger than all the codes before it
+    seen = np.maximum.accumulate(codes)
+    first = np.flatnonzero(codes > np.concatenate(([-1], seen[:-1])))
+    columns = set(table.column_names)
+    rest = table.drop_columns([col for col in _geometry_columns if col in columns])
+    return {
+        "precision": COORDINATE_PRECISION,
+        "stops": {
+            "name": names.take(first).to_pylist(),
+            "lat": lats[first],
+            "lon": lons[first],
+        },
+        "from": codes[: table.num_rows],
+        "to": codes[table.num_rows :],
+        **_arrow_columns(rest),
+    }
+
+
+def wants_compact() -> bool:
+    return request.args.get("shape") == "compact"
+
+
+# Web maps do not zoom in further than this
+MAX_ZOOM = 24
+
+
+def viewport() -> queries.Viewport | None:
+    """?bbox=west,south,east,north in degrees and/or ?zoom=level of the map, see queries.Viewport"""
+    bbox = request.args.get("bbox")
+    zoom = request.args.get("zoom")
+    if bbox is None and zoom is None:
+        return None
+    try:
+        west, south, east, north = (
+            [float(value) for value in bbox.split(",")]
+            if bbox is not None
+            else [-180.0, -90.0, 180.0, 90.0]
+        )
+        level = int(float(zoom)) if zoom is not None else None
+    except (ValueError, OverflowError):
+        abort(400, description="bbox must be west,south,east,north and zoom a number")
+    # NaN and infinity fail these comparisons too
+    if not (
+        -180 <= west < east <= 180
+        and -90 <= south < north <= 90
+        and (level is None or 0 <= level <= MAX_ZOOM)
+    ):
+        abort(
+            400,
+            description=f"bbox must be within -180,-90,180,90 with west < east and south < north, and zoom from 0 to {MAX_ZOOM}",
+        )
+    return queries.Viewport(west, south, east, north, level)
+
+
+def to_json(df: "pd.DataFrame | pa.Table", compact: bool = False) -> Response:
+    started = time.perf_counter()
+    if compact:
+        table = (
+            df
+            if isinstance(df, pa.Table)
+            else pa.Table.from_pandas(df, preserve_index=False)
+        )
+        data = _compact_columns(table)
+    elif isinstance(df, pa.Table):
+        data = _arrow_columns(df)
+    else:
+        from pandas.api.types import is_numeric_dtype
+
+        data = {
             column: df[column].to_numpy()
             if is_numeric_dtype(df[column])
             else df[column].tolist()
             for column in df.columns
-        },
+        }
+    resp = orjson.dumps(
+        data,
         option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC,
     )
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.serialization_seconds.observe(time.perf_counter() - started, route)
     return Response(resp, content_type="application/json")
 
 
 @app.route("/hot-spots/<int:year>/<int:month>/<int:hour>")
 def hot_spots(year: int, month: int, hour: int) -> Response:
     partition = date(year, month, 1)
-    data = queries.hot_spots(g.db, partition, hour, limit=1000)
-    return to_json(data)
+    view = viewport()
+    data = (
+        g.store.hot_spots(partition, hour, limit=1000, viewport=view)
+        if g.store is not None
+        else queries.hot_spots(g.db, partition, hour, limit=1000, viewport=view)
+    )
+    return to_json(data, compact=wants_compact())
 
 
 @app.route("/leg-stats/<int:year>/<int:month>/<int:hour>/<datasource>")
 def leg_stats(year: int, month: int, hour: int, datasource: str) -> Response:
     partition = date(year, month, 1)
     line_ref = request.args.get("line_ref")
-    data = queries.legs(g.db, partition, hour, datasource, line_ref)
-    return to_json(data)
+    view = viewport()
+    data = (
+        g.store.legs(partition, hour, datasource, line_ref, viewport=view)
+        if g.store is not None
+        else queries.legs(g.db, partition, hour, datasource, line_ref, viewport=view)
+    )
+    return to_json(data, compact=wants_compact())
+
+
+@app.route("/leg-stats-by-hour/<int:year>/<int:month>/<datasource>")
+def leg_stats_by_hour(year: int, month: int, datasource: str) -> Response:
+    partition = date(year, month, 1)
+    line_ref = request.args.get("line_ref")
+    data = queries.legs_by_hour(g.db, partition, datasource, line_ref)
+    return to_json(data, compact=wants_compact())
+
+
+@app.route("/leg-history/<datasource>")
+def leg_history(datasource: str) -> Response:
+    # Stop names can have slashes in them, so they are not in the path
+    from_stop = request.args.get("from_stop")
+    to_stop = request.args.get("to_stop")
+    if from_stop is None or to_stop is None:
+        abort(400, description="from_stop and to_stop are required")
+    return to_json(queries.leg_history(g.db, datasource, from_stop, to_stop))
+
+
+@app.route("/travel-time/<int:year>/<int:month>/<int:hour>/<datasource>")
+def travel_time(year: int, month: int, hour: int, datasource: str) -> Response:
+    line_ref = request.args.get("line_ref")
+    from_stop = request.args.get("from_stop")
+    to_stop = request.args.get("to_stop")
+    if line_ref is None or from_stop is None or to_stop is None:
+        abort(400, description="line_ref, from_stop and to_stop are required")
+    found = queries.travel_time(
+        g.db, date(year, month, 1), hour, datasource, line_ref, from_stop, to_stop
+    )
+    if found is None:
+        abort(404, description="No travel time between these stops on this line")
+    return jsonify(found)
 
 
 @app.route(
@@ -63,16 +392,90 @@ def comparison(
     line_ref = request.args.get("line_ref")
     cur = date(cur_year, cur_month, 1)
     prev = date(prev_year, prev_month, 1)
-    data = queries.comparisons(
-        g.db,
-        prev_month=prev,
-        cur_month=cur,
-        hour=hour,
-        data_source=data_source,
-        line_ref=line_ref,
-        limit=2000,
+    view = viewport()
+    data = (
+        g.store.comparisons(
+            prev, cur, hour, 2000, data_source, line_ref, viewport=view
+        )
+        if g.store is not None
+        else queries.comparisons(
+            g.db, prev, cur, hour, 2000, data_source, line_ref, viewport=view
+        )
     )
-    return to_json(data)
+    return to_json(data, compact=wants_compact())
+
+
+def _bounded(name: str, default: int, most: int) -> int:
+    try:
+        return min(max(int(request.args.get(name, default)), 0), most)
+    except ValueError:
+        abort(400, description=f"{name} must be an integer")
+
+
+@app.route("/stops/nearest")
+def nearest_stops() -> Response:
+    if g.stops is None:
+        abort(503, description="There is no stop index")
+    try:
+        lat, lon = float(request.args["lat"]), float(request.args["lon"])
+    except (KeyError, ValueError):
+        abort(400, description="lat and lon are required")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        abort(400, description="lat and lon must be degrees")
+    return jsonify(g.stops.nearest(lat, lon, k=_bounded("k", 10, 100)))
+
+
+@app.route("/stops/search")
+def search_stops() -> Response:
+    if g.stops is None:
+        abort(503, description="There is no stop index")
+    prefix = request.args.get("q", "")
+    return jsonify(g.stops.search(prefix, limit=_bounded("limit", 10, 100)))
+
+
+def _date_arg(name: str) -> date:
+    try:
+        return date.fromisoformat(request.args[name])
+    except (KeyError, ValueError):
+        abort(400, description=f"{name} must be a date like 2025-03-01")
+
+
+@app.route("/export/<any('leg-stats', legs):dataset>")
+def bulk_export(dataset: str) -> Response:
+    """All rows of a dataset between two dates, as an Arrow IPC stream or a Parquet file
+
+    The first download of an extract streams straight from DuckDB, as a full 200
+    response even when a Range was asked for. The extract is completed in the export
+    cache even if the client leaves, and from there it supports Range requests.
+    """
+    if g.exports is None:
+        abort(503, description="Exports are not available")
+    extract = export.Extract(
+        dataset=dataset,
+        start=_date_arg("from"),
+        end=_date_arg("to"),
+        data_source=request.args.get("data_source"),
+        line_ref=request.args.get("line_ref"),
+        format=request.args.get("format", "arrow"),
+    )
+    if extract.format not in export.FORMATS or extract.start > extract.end:
+        abort(400, description="format must be arrow or parquet, and from before to")
+    version = g.version
+    path = g.exports.find(extract, version) if version is not None else None
+    if path is not None and version is not None:
+        response = send_file(
+            path, mimetype=extract.content_type, conditional=True, etag=version
+        )
+    else:
+        # The pooled cursor goes back to the pool before the body is streamed
+        response = Response(
+            g.exports.stream(g.db.cursor(), extract, version),
+            content_type=extract.content_type,
+        )
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="{dataset}{export.FORMATS[extract.format][1]}"'
+    )
+    return response
 
 
 @app.route("/datasource-names")
@@ -82,9 +485,15 @@ def datasources() -> Response:
 
 @app.route("/partitions")
 def partitions() -> Response:
+    modes = queries.quantiles(g.db)
     return jsonify(
         [
-            {"year": d.year, "month": d.month}
+            {
+                "year": d.year,
+                "month": d.month,
+                "version": g.versions.get(d),
+                "quantiles": modes.get(d, "exact"),
+            }
             for d in queries.months(g.db)
             # Hide partitions that have too little data
             if d <= date.today() - timedelta(days=7)
@@ -0,0 +1,178 @@
+"""
+Serve the webapp over ASGI, with the Flask app running on a bounded thread pool
+
+With sync gunicorn workers, a request holds its worker until the client has received the
+whole body, so a few slow clients downloading large responses can block everyone else.
+Here, each request runs webapp.server on a pool with as many threads as DuckDB has in
+webapp.open_db, and the event loop sends the body to the client in chunks, so a slow
+client only holds a coroutine and the pool moves on to the next request. Run it with:
+
+gunicorn -c python:kollektivkart.gunicorn_conf -k uvicorn_worker.UvicornWorker kollektivkart.asgi:app
+
+Streamed responses, like /api/export, are iterated on the pool too, since producing each
+chunk may run a DuckDB query.
+"""
+
+import asyncio
+import io
+import logging
+import sys
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from types import TracebackType
+from typing import Any
+
+from . import webapp
+
+# Bodies are sent in chunks of at most this size, so the server can apply backpressure
+CHUNK_SIZE = 64 * 1024
+
+_pool = ThreadPoolExecutor(max_workers=webapp.threads, thread_name_prefix="wsgi")
+
+_ExcInfo = (
+    tuple[type[BaseException], BaseException, TracebackType] | tuple[None, None, None]
+)
+
+
+def _environ(scope: dict[str, Any], body: bytes) -> dict[str, object]:
+    """The WSGI environ of an ASGI http scope, see PEP 3333"""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ: dict[str, object] = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope["headers"]:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+class _Response:
+    """Runs the WSGI app and hands out its body, meant to be called on the pool"""
+
+    def __init__(self, environ: dict[str, object]):
+        self.status = 500
+        self.headers: list[tuple[bytes, bytes]] = []
+        self._written: list[bytes] = []
+        self._body: Iterable[bytes] = webapp.server.wsgi_app(
+            environ, self._start_response
+        )
+        self._chunks: Iterator[bytes] = iter(self._body)
+
+    def _start_response(
+        self,
+        status: str,
+        headers: list[tuple[str, str]],
+        exc_info: _ExcInfo | None = None,
+        /,
+    ) -> Callable[[bytes], object]:
+        if exc_info is not None and exc_info[1] is not None:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status = int(status.split(" ", 1)[0])
+        self.headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ]
+        return self._write
+
+    def _write(self, data: bytes):
+        # Only for apps that write before returning their body, Flask does not
+        self._written.append(data)
+
+    def next_chunk(self) -> bytes | None:
+        """The next non-empty chunk of the body, None at the end"""
+        written = b"".join(self._written)
+        self._written.clear()
+        if written:
+            return written
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return None
+
+    def close(self):
+        close = getattr(self._body, "close", None)
+        if close is not None:
+            close()
+
+
+async def _read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.extend(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return bytes(body)
+
+
+async def _http(scope: dict[str, Any], receive, send):
+    loop = asyncio.get_running_loop()
+    environ = _environ(scope, await _read_body(receive))
+    response = await loop.run_in_executor(_pool, _Response, environ)
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status,
+                "headers": response.headers,
+            }
+        )
+        while (chunk := await loop.run_in_executor(_pool, response.next_chunk)) is not None:
+            view = memoryview(chunk)
+            for start in range(0, len(view), CHUNK_SIZE):
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": bytes(view[start : start + CHUNK_SIZE]),
+                        "more_body": True,
+                    }
+                )
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        await loop.run_in_executor(_pool, response.close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            webapp.start_warming()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # DuckDB aborts the process if it exits in the middle of a query
+            await asyncio.get_running_loop().run_in_executor(
+                None, webapp.warmed.wait, 10
+            )
+            _pool.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: dict[str, Any], receive, send):
+    if scope["type"] == "http":
+        await _http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    else:
+        logging.warning("Unsupported ASGI scope %s", scope["type"])
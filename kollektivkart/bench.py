@@ -0,0 +1,597 @@
+"""
+Time the ETL jobs and the API on synthetic data, and store the timings as JSON
+
+Generates data with etl.synthetic into a folder, runs legs, leg_stats and mkdb on it like
+python -m kollektivkart.etl --skip-bq would, then requests each API endpoint through the
+Flask test client, with the columnar store and with DuckDB. Nothing goes over the network,
+but the legs job needs the DuckDB spatial extension to be installed already. With
+--slow-clients, it also starts gunicorn with sync and with ASGI workers.
+
+Compare two runs with --compare, e.g.
+
+python -m kollektivkart.bench --out before.json
+git switch my-branch
+python -m kollektivkart.bench --out after.json --compare before.json
+"""
+
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections.abc import Callable
+from dataclasses import asdict
+from datetime import date, datetime, timezone
+from os.path import join
+from typing import Any
+from urllib.parse import quote, urlencode
+from urllib.request import urlopen
+
+import duckdb
+from duckdb import DuckDBPyConnection
+
+from . import queries
+from .etl import leg_stats, legs, mkdb, synthetic
+
+parser = ArgumentParser(
+    description=__doc__, formatter_class=RawDescriptionHelpFormatter
+)
+parser.add_argument(
+    "--data",
+    help="Folder for the synthetic data, reused if it has arrivals already (default: a temp dir)",
+    type=str,
+)
+parser.add_argument("--out", default="bench.json", help="Write results here", type=str)
+parser.add_argument(
+    "--compare", metavar="JSON", help="Print the change from an earlier run", type=str
+)
+parser.add_argument(
+    "--start", default=synthetic.Scale.start, type=date.fromisoformat, help="First day"
+)
+parser.add_argument("--days", default=synthetic.Scale.days, type=int)
+parser.add_argument("--lines", default=synthetic.Scale.lines, type=int)
+parser.add_argument(
+    "--journeys",
+    default=synthetic.Scale.journeys,
+    type=int,
+    help="Journeys of each line in each direction each day",
+)
+parser.add_argument("--stops-per-line", default=synthetic.Scale.stops_per_line, type=int)
+parser.add_argument("--data-sources", default=synthetic.Scale.data_sources, type=int)
+parser.add_argument("--seed", default=synthetic.Scale.seed, type=int)
+parser.add_argument(
+    "--repeat", default=20, type=int, help="Requests to time for each url"
+)
+parser.add_argument("--threads", default=4, type=int, help="DuckDB threads for the ETL")
+parser.add_argument(
+    "--quantiles",
+    choices=sorted(leg_stats.QUANTILES),
+    default="exact",
+    help="Quantiles for leg_stats.run_job",
+)
+parser.add_argument(
+    "--quantile-accuracy",
+    action="store_true",
+    help="Compare approximate and exact leg stats for the latest month of legs",
+)
+parser.add_argument(
+    "--slow-clients",
+    default=0,
+    type=int,
+    metavar="N",
+    help="Also serve with gunicorn, sync and ASGI, to N clients that read slowly at once",
+)
+parser.add_argument(
+    "--workers", default=4, type=int, help="gunicorn workers for --slow-clients"
+)
+parser.add_argument(
+    "--skip-etl",
+    action="store_true",
+    help="Only time the API, on a --data folder that has stats.db already",
+)
+
+
+def timed(results: dict[str, float], name: str, job: Callable[[], object]):
+    started = time.perf_counter()
+    job()
+    results[name] = round(time.perf_counter() - started, 3)
+    logging.info("%s took %.2fs", name, results[name])
+
+
+def time_etl(
+    db: DuckDBPyConnection,
+    root: str,
+    scale: synthetic.Scale,
+    quantiles: str = "exact",
+) -> dict[str, float]:
+    results: dict[str, float] = {}
+    if not os.path.isdir(join(root, "arrivals.parquet")):
+        timed(results, "synthetic", lambda: synthetic.run_job(db, root, scale))
+    timed(results, "legs", lambda: legs.run_job(db, root, True, scale.start))
+    timed(
+        results,
+        "leg_stats",
+        lambda: leg_stats.run_job(db, root, True, scale.start, quantiles),
+    )
+    timed(results, "mkdb", lambda: mkdb.run_job(root))
+    return results
+
+
+_quantile_columns = [
+    "hourly_quartile",
+    "hourly_duration",
+    "hourly_delay",
+    "hourly_deviation",
+    "monthly_quartile",
+    "monthly_duration",
+    "monthly_delay",
+    "monthly_deviation",
+]
+
+
+# Run in a fresh interpreter, so the peak memory is that of computing the leg stats
+_leg_stats_run = """
+import json, resource, sys, time
+import duckdb
+from kollektivkart.etl import leg_stats
+mode, month, legs, dest, threads = sys.argv[1:]
+db = duckdb.connect()
+db.execute(f"set threads = {threads}")
+# The progress bar of slow queries goes to stdout, where the timing goes
+db.execute("set enable_progress_bar = false")
+db.execute(leg_stats.QUANTILES[mode])
+started = time.perf_counter()
+db.execute(
+    f"COPY ({leg_stats._leg_stats}) TO '{dest}' (format parquet)",
+    parameters=dict(month=month, legs=legs),
+)
+print(json.dumps(dict(
+    seconds=time.perf_counter() - started,
+    max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+)))
+"""
+
+
+def quantile_accuracy(db: DuckDBPyConnection, root: str, threads: int) -> dict[str, object]:
+    """Seconds apart for each quantile column, between approximate and exact leg stats
+
+    Uses the latest month of legs.parquet, and also reports the time and peak memory of
+    both ways of computing it.
+    """
+    legs_parquet = join(root, "legs.parquet/*/*")
+    (month,) = _one(
+        db,
+        "select max(date_trunc('month', operatingDate)) :: date from read_parquet($legs, hive_partitioning=true)",
+        legs=legs_parquet,
+    )
+    results: dict[str, object] = dict(month=month.isoformat())
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in leg_stats.QUANTILES:
+            run = subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    _leg_stats_run,
+                    mode,
+                    month.isoformat(),
+                    legs_parquet,
+                    join(tmp, f"{mode}.parquet"),
+                    str(threads),
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            timing = json.loads(run.stdout)
+            results[f"{mode}_seconds"] = round(timing["seconds"], 3)
+            results[f"{mode}_max_rss_mb"] = timing["max_rss_mb"]
+        errors = ",\n".join(
+            f"avg(abs(a.{column} - e.{column})), "
+            f"quantile_disc(abs(a.{column} - e.{column}), .95), "
+            f"max(abs(a.{column} - e.{column}))"
+            for column in _quantile_columns
+        )
+        row = _one(
+            db,
+            f"""
+            from read_parquet('{join(tmp, "exact.parquet")}') e
+              join read_parquet('{join(tmp, "approx.parquet")}') a
+              using (month, hour, dataSource, from_stop, to_stop)
+            select count(*), {errors}
+            """,
+        )
+    results["rows"] = row[0]
+    results["columns"] = {
+        column: dict(
+            mean_abs=round(float(row[1 + 3 * i]), 2),
+            p95_abs=row[2 + 3 * i],
+            max_abs=row[3 + 3 * i],
+        )
+        for i, column in enumerate(_quantile_columns)
+    }
+    logging.info("Quantile accuracy %s", results)
+    return results
+
+
+# The busiest leg of the latest month, at its busiest hour, and the ends of the stretch of a
+# line it is on that has stats for every leg
+_sample = """
+with leg as (
+  from leg_stats join stop_line using (dataSource, from_stop, to_stop)
+  select month :: date as month, hour :: int4 as hour, dataSource, lineRef, from_stop, to_stop
+  order by month desc, hourly_count desc, dataSource, lineRef, from_stop, to_stop
+  limit 1
+)
+from leg join line_travel_time t using (month, hour, dataSource, lineRef)
+select
+  month,
+  hour,
+  dataSource,
+  lineRef,
+  any_value(leg.from_stop),
+  any_value(leg.to_stop),
+  min_by(t.stop, t.position) filter (t.missing_legs = 0),
+  max_by(t.stop, t.position) filter (t.missing_legs = 0)
+group by month, hour, dataSource, lineRef, t.direction
+order by t.direction
+limit 1
+"""
+
+_stop_area = """
+from stops select avg(lat), avg(lon), min(lon), min(lat), max(lon), max(lat)
+"""
+
+
+def _one(db: DuckDBPyConnection, query: str, **params: object) -> tuple[Any, ...]:
+    """The only row of query, which the benchmark can not do without"""
+    row = db.sql(query, params=params or None).fetchone()
+    if row is None:
+        raise ValueError(f"No rows from {query}")
+    return row
+
+
+def api_urls(db: DuckDBPyConnection) -> list[str]:
+    """A url for each API endpoint, with the busiest leg of the latest month"""
+    months = sorted(
+        row[0] for row in db.sql("select distinct month :: date from leg_stats").fetchall()
+    )
+    (
+        month,
+        hour,
+        data_source,
+        line_ref,
+        from_stop,
+        to_stop,
+        first_stop,
+        last_stop,
+    ) = _one(db, _sample)
+    lat, lon, *bbox = _one(db, _stop_area)
+    prev = months[-2] if len(months) > 1 else month
+    ym = f"{month.year}/{month.month}"
+    ds = quote(data_source, safe="")
+    view = urlencode(dict(bbox=",".join(str(value) for value in bbox), zoom=12))
+    return [
+        "/api/partitions",
+        "/api/datasource-names",
+        f"/api/lines/{ds}",
+        "/api/stats",
+        f"/api/hot-spots/{ym}/{hour}",
+        f"/api/hot-spots/{ym}/{hour}?{view}",
+        f"/api/leg-stats/{ym}/{hour}/{ds}",
+        f"/api/leg-stats/{ym}/{hour}/{ds}?shape=compact",
+        f"/api/leg-stats/{ym}/{hour}/{ds}?{urlencode(dict(line_ref=line_ref))}",
+        f"/api/leg-stats-by-hour/{ym}/{ds}",
+        f"/api/leg-history/{ds}?{urlencode(dict(from_stop=from_stop, to_stop=to_stop))}",
+        f"/api/travel-time/{ym}/{hour}/{ds}?"
+        + urlencode(dict(line_ref=line_ref, from_stop=first_stop, to_stop=last_stop)),
+        f"/api/comparison/{ym}/{prev.year}/{prev.month}/{hour}",
+        f"/api/comparison/{ym}/{prev.year}/{prev.month}/{hour}?"
+        + urlencode(dict(data_source=data_source, line_ref=line_ref)),
+        f"/api/stops/nearest?{urlencode(dict(lat=lat, lon=lon))}",
+        f"/api/stops/search?{urlencode(dict(q=from_stop[:4]))}",
+        f"/api/export/leg-stats?from={month.isoformat()}&to={month.isoformat()}",
+    ]
+
+
+def _p95(seconds: list[float]) -> float:
+    if len(seconds) < 2:
+        return seconds[0]
+    return statistics.quantiles(seconds, n=20, method="inclusive")[-1]
+
+
+def time_url(client, url: str, repeat: int) -> dict[str, object]:
+    # The first request prepares statements and fills caches, so it is timed on its own
+    started = time.perf_counter()
+    response = client.get(url)
+    first = time.perf_counter() - started
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        client.get(url).get_data()
+        seconds.append(time.perf_counter() - started)
+    return dict(
+        status=response.status_code,
+        bytes=len(response.get_data()),
+        first_ms=round(first * 1000, 2),
+        median_ms=round(statistics.median(seconds) * 1000, 2),
+        p95_ms=round(_p95(seconds) * 1000, 2),
+    )
+
+
+# Run in a fresh interpreter, so nothing is imported yet
+_startup = """
+import json, sys, time
+started = time.perf_counter()
+from kollektivkart import webapp
+imported = time.perf_counter()
+webapp.start_warming()
+status = webapp.server.test_client().get(sys.argv[1]).status_code
+responded = time.perf_counter()
+webapp.warmed.wait()
+ready = time.perf_counter()
+print(json.dumps(dict(
+    status=status,
+    import_seconds=imported - started,
+    first_response_seconds=responded - started,
+    ready_seconds=ready - started,
+)))
+"""
+
+
+def time_startup(root: str, url: str, repeat: int = 5) -> dict[str, object]:
+    """Median seconds from the start of a worker until it is imported, has served url and is warm"""
+    env = dict(os.environ, PARQUET_LOCATION=root)
+    runs = [
+        json.loads(
+            subprocess.run(
+                [sys.executable, "-c", _startup, url],
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+        )
+        for _ in range(repeat)
+    ]
+    results: dict[str, object] = dict(url=url, status=runs[0]["status"])
+    for key in ("import_seconds", "first_response_seconds", "ready_seconds"):
+        results[key] = round(statistics.median(run[key] for run in runs), 3)
+    logging.info("Startup %s", results)
+    return results
+
+
+def time_api(root: str, repeat: int) -> dict[str, dict[str, dict[str, object]]]:
+    """Timings of each url, served with the columnar store, and from DuckDB only"""
+    # The webapp reads its configuration at import
+    os.environ["PARQUET_LOCATION"] = root
+    os.environ.setdefault("EXPORT_CACHE", join(root, "exports"))
+    from . import webapp
+
+    with webapp.open_db() as db:
+        urls = api_urls(db)
+    # Warming up runs in the background, and would compete with the timed requests
+    webapp.start_warming()
+    webapp.warmed.wait()
+    client = webapp.server.test_client()
+    results: dict[str, dict[str, dict[str, object]]] = {}
+    worker = webapp.worker()
+    store = worker.store
+    for name, serving in (("columnar", store), ("duckdb", None)):
+        if name == "columnar" and store is None:
+            continue
+        worker.store = serving
+        results[name] = {}
+        for url in urls:
+            results[name][url] = time_url(client, url, repeat)
+            logging.info("%s %s %s", name, url, results[name][url])
+    worker.store = store
+    return results
+
+
+_servers = {
+    "sync": ["kollektivkart.webapp:server"],
+    "asgi": ["-k", "uvicorn_worker.UvicornWorker", "kollektivkart.asgi:app"],
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _get(port: int, url: str, read_delay: float = 0.0) -> int:
+    """GET url and read the response 16 KiB at a time, sleeping read_delay in between"""
+    sock = socket.socket()
+    if read_delay:
+        # Otherwise the kernel buffers take most of the response off the server right away
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    writer.write(
+        f"GET {url} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode()
+    )
+    await writer.drain()
+    received = 0
+    while chunk := await reader.read(16384):
+        received += len(chunk)
+        if read_delay:
+            await asyncio.sleep(read_delay)
+    writer.close()
+    return received
+
+
+async def _slow_clients(port: int, url: str, clients: int, pid: int) -> dict[str, object]:
+    import psutil
+
+    server = psutil.Process(pid)
+    slow = [
+        asyncio.create_task(asyncio.wait_for(_get(port, url, 0.05), 120))
+        for _ in range(clients)
+    ]
+    probes: list[float] = []
+    probe_failures = 0
+    max_rss = 0
+    started = time.perf_counter()
+    while not all(task.done() for task in slow):
+        processes = [server, *server.children(recursive=True)]
+        max_rss = max(max_rss, sum(p.memory_info().rss for p in processes))
+        probe_started = time.perf_counter()
+        try:
+            await asyncio.wait_for(_get(port, "/api/partitions"), 10)
+            probes.append(time.perf_counter() - probe_started)
+        except (OSError, asyncio.TimeoutError):
+            probe_failures += 1
+        await asyncio.sleep(0.1)
+    seconds = time.perf_counter() - started
+    done = [task for task in slow if task.exception() is None]
+    return dict(
+        completed=len(done),
+        failed=clients - len(done),
+        seconds=round(seconds, 2),
+        probe_median_ms=round(statistics.median(probes) * 1000, 2) if probes else None,
+        probe_p95_ms=round(_p95(probes) * 1000, 2) if probes else None,
+        probe_failed=probe_failures,
+        max_rss_mb=max_rss // 2**20,
+    )
+
+
+def time_slow_clients(
+    root: str, url: str, clients: int, workers: int
+) -> dict[str, dict[str, object]]:
+    """Serve url to clients that read slowly at once, with sync and ASGI gunicorn workers
+
+    Meanwhile, /api/partitions is requested by a fast client, to see if the server still
+    answers it, and the memory of the server and its workers is sampled.
+    """
+    env = dict(os.environ, PARQUET_LOCATION=root)
+    results: dict[str, dict[str, object]] = {}
+    for mode, app in _servers.items():
+        port = _free_port()
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "-c",
+                "python:kollektivkart.gunicorn_conf",
+                "-w",
+                str(workers),
+                "-b",
+                f"127.0.0.1:{port}",
+                *app,
+            ],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(600):
+                try:
+                    with urlopen(f"http://127.0.0.1:{port}/ready", timeout=1):
+                        break
+                except OSError:
+                    time.sleep(0.1)
+            results[mode] = asyncio.run(_slow_clients(port, url, clients, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+        logging.info("Slow clients %s %s", mode, results[mode])
+    return results
+
+
+def compare(before: dict[str, Any], after: dict[str, Any]) -> list[str]:
+    """Lines with the timings of before and after, and their ratio, for what both have"""
+    lines = []
+    rows = [
+        (f"etl {name}", seconds * 1000, after["etl"][name] * 1000)
+        for name, seconds in before.get("etl", {}).items()
+        if name in after.get("etl", {})
+    ]
+    rows.extend(
+        (f"startup {name}", seconds * 1000, after["startup"][name] * 1000)
+        for name, seconds in before.get("startup", {}).items()
+        if name.endswith("_seconds") and name in after.get("startup", {})
+    )
+    for mode, urls in before.get("api", {}).items():
+        rows.extend(
+            (f"{mode} {url}", timing["median_ms"], after["api"][mode][url]["median_ms"])
+            for url, timing in urls.items()
+            if url in after.get("api", {}).get(mode, {})
+        )
+    for name, old, new in rows:
+        ratio = new / old if old else float("nan")
+        lines.append(f"{old:10.2f}ms {new:10.2f}ms {ratio:6.2f}x  {name}")
+    return lines
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    opts = parser.parse_args()
+    scale = synthetic.Scale(
+        start=opts.start,
+        days=opts.days,
+        lines=opts.lines,
+        journeys=opts.journeys,
+        stops_per_line=opts.stops_per_line,
+        data_sources=opts.data_sources,
+        seed=opts.seed,
+    )
+    root = opts.data or tempfile.mkdtemp(prefix="kollektivkart-bench-")
+    results: dict[str, object] = dict(
+        started=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        duckdb=duckdb.__version__,
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+        data=root,
+        scale={
+            key: value.isoformat() if isinstance(value, date) else value
+            for key, value in asdict(scale).items()
+        },
+    )
+    if not opts.skip_etl:
+        db = duckdb.connect(":memory:")
+        db.execute(f"set threads = {opts.threads};")
+        try:
+            db.execute("load spatial;")
+        except duckdb.IOException:
+            sys.exit("The spatial extension is needed, run: install spatial; in duckdb")
+        results["etl"] = time_etl(db, root, scale, opts.quantiles)
+        db.close()
+    if opts.quantile_accuracy:
+        with duckdb.connect(":memory:") as db:
+            db.execute(f"set threads = {opts.threads};")
+            results["quantile_accuracy"] = quantile_accuracy(db, root, opts.threads)
+    # The hot spots of the latest month are what the map opens with
+    with duckdb.connect(join(root, "stats.db"), read_only=True) as db:
+        latest = max(queries.months(db))
+    results["startup"] = time_startup(
+        root, f"/api/hot-spots/{latest.year}/{latest.month}/8"
+    )
+    results["api"] = time_api(root, opts.repeat)
+    if opts.slow_clients > 0:
+        results["slow_clients"] = time_slow_clients(
+            root,
+            f"/api/hot-spots/{latest.year}/{latest.month}/8",
+            opts.slow_clients,
+            opts.workers,
+        )
+    with open(opts.out, "w") as out:
+        json.dump(results, out, indent=1)
+    logging.info("Wrote results to %s", opts.out)
+    if opts.compare:
+        with open(opts.compare) as f:
+            print("\n".join(compare(json.load(f), results)))
+
+
+if __name__ == "__main__":
+    main()
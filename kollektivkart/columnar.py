@@ -0,0 +1,270 @@
+"""
+Serve the fixed leg queries from memory-mapped Arrow IPC files written by etl.mkdb
+
+The files are laid out with one record batch per (month, hour), sorted by data source and
+rush intensity, so most responses are zero-copy slices of pages in the OS page cache,
+which is shared between all gunicorn workers.
+"""
+
+# The functions of pyarrow.compute are generated when it is imported, so pyright can not see them
+# pyright: reportAttributeAccessIssue=false
+
+from datetime import date
+from os.path import join
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from . import metrics
+from .etl.columnar import LEG_STATS, LEG_STATS_INDEX, STOP_LINE, STOP_LINE_INDEX
+from .queries import Viewport
+
+_leg_key = ["data_source", "from_stop", "to_stop"]
+
+_comparison_metrics = [
+    "hourly_quartile",
+    "hourly_duration",
+    "hourly_delay",
+    "hourly_deviation",
+    "mean_hourly_duration",
+    "monthly_count",
+    "hourly_count",
+]
+
+
+def _read_all(path: str) -> pa.Table:
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def _to_int(values: pa.Array) -> pa.Array:
+    return pc.cast(pc.round(values), pa.int32())
+
+
+def _divide(numerator: pa.Array, denominator: pa.Array) -> pa.Array:
+    denominator = pc.cast(denominator, pa.float64())
+    return pc.if_else(
+        pc.equal(denominator, 0),
+        pa.scalar(None, pa.float64()),
+        pc.divide(pc.cast(numerator, pa.float64()), denominator),
+    )
+
+
+def _in_view(table: pa.Table, viewport: Viewport) -> pa.Table:
+    lon, lat = table["from_lon"], table["from_lat"]
+    return table.filter(
+        pc.and_(
+            pc.and_(
+                pc.greater_equal(lon, viewport.west), pc.less_equal(lon, viewport.east)
+            ),
+            pc.and_(
+                pc.greater_equal(lat, viewport.south),
+                pc.less_equal(lat, viewport.north),
+            ),
+        )
+    )
+
+
+def _top_per_cell(table: pa.Table, viewport: Viewport, rank: str) -> pa.Table:
+    """Keep the rows of table ranking highest by rank in each cell, like queries._top_per_cell"""
+    per_cell, cell_shift = viewport.per_cell, viewport.cell_shift
+    if per_cell is None or cell_shift is None:
+        return table
+    cells = pc.shift_right(table["tile"], pa.scalar(cell_shift, pa.uint32()))
+    order = pc.sort_indices(
+        table.append_column("cell", cells),
+        sort_keys=[
+            ("cell", "ascending"),
+            (rank, "descending"),
+            ("data_source", "ascending"),
+            ("from_stop", "ascending"),
+            ("to_stop", "ascending"),
+        ],
+    ).to_numpy()
+    ordered = cells.take(order).to_numpy()
+    starts = np.flatnonzero(np.concatenate(([True], ordered[1:] != ordered[:-1])))
+    sizes = np.diff(np.append(starts, len(order)))
+    place_in_cell = np.arange(len(order)) - np.repeat(starts, sizes)
+    # Put the rows that are left back in the order of table
+    return table.take(np.sort(order[place_in_cell < per_cell]))
+
+
+def _top(table: pa.Table, k: int, rank: str) -> pa.Table:
+    """The k rows of table ranking highest by rank, in no particular order"""
+    if table.num_rows == 0:
+        # select_k_unstable fails on empty tables
+        return table
+    return table.take(
+        pc.select_k_unstable(table, k=k, sort_keys=[(rank, "descending")])
+    )
+
+
+class ColumnarStore:
+    def __init__(self, location: str):
+        self._leg_stats = pa.ipc.open_file(pa.memory_map(join(location, LEG_STATS)))
+        self.schema = self._leg_stats.schema
+        # The grid cell is only used for viewports, see etl.mkdb.GRID_ZOOM
+        self._columns = [name for name in self.schema.names if name != "tile"]
+        self._batches: dict[tuple[date, int], int] = {}
+        self._slices: dict[tuple[date, int, str], tuple[int, int, int]] = {}
+        for row in _read_all(join(location, LEG_STATS_INDEX)).to_pylist():
+            key = (row["month"], row["hour"])
+            self._batches[key] = row["batch"]
+            self._slices[(*key, row["data_source"])] = (
+                row["batch"],
+                row["offset"],
+                row["length"],
+            )
+        self._stop_line = _read_all(join(location, STOP_LINE))
+        self._lines = {
+            row["line_ref"]: (row["offset"], row["length"])
+            for row in _read_all(join(location, STOP_LINE_INDEX)).to_pylist()
+        }
+
+    def _empty(self) -> pa.Table:
+        return self.schema.empty_table()
+
+    def _partition(self, month: date, hour: int) -> pa.Table:
+        batch = self._batches.get((month, hour))
+        if batch is None:
+            return self._empty()
+        return pa.Table.from_batches([self._leg_stats.get_batch(batch)])
+
+    def _data_source(self, month: date, hour: int, data_source: str) -> pa.Table:
+        found = self._slices.get((month, hour, data_source))
+        if found is None:
+            return self._empty()
+        batch, offset, length = found
+        return pa.Table.from_batches(
+            [self._leg_stats.get_batch(batch).slice(offset, length)]
+        )
+
+    def _on_line(self, table: pa.Table, line_ref: str) -> pa.Table:
+        offset, length = self._lines.get(line_ref, (0, 0))
+        legs = self._stop_line.slice(offset, length)
+        keys = pc.binary_join_element_wise(*(legs[col] for col in _leg_key), "\x1f")
+        wanted = pc.is_in(
+            pc.binary_join_element_wise(*(table[col] for col in _leg_key), "\x1f"),
+            value_set=keys.combine_chunks(),
+        )
+        return table.filter(wanted)
+
+    @metrics.timed("columnar_legs")
+    def legs(
+        self,
+        month: date,
+        hour: int,
+        data_source: str,
+        line_ref: str | None = None,
+        viewport: Viewport | None = None,
+    ) -> pa.Table:
+        found = self._data_source(month, hour, data_source)
+        if line_ref is not None:
+            found = self._on_line(found, line_ref)
+        if viewport is not None:
+            found = _top_per_cell(_in_view(found, viewport), viewport, "rush_intensity")
+        return found.select(self._columns)
+
+    @metrics.timed("columnar_hot_spots")
+    def hot_spots(
+        self,
+        month: date,
+        hour: int,
+        limit: int = 1000,
+        viewport: Viewport | None = None,
+    ) -> pa.Table:
+        found = self._partition(month, hour)
+        if viewport is not None:
+            found = _top_per_cell(_in_view(found, viewport), viewport, "rush_intensity")
+        top = _top(found.select(self._columns), limit, "rush_intensity")
+        return top.sort_by("rush_intensity")
+
+    @metrics.timed("columnar_comparisons")
+    def comparisons(
+        self,
+        prev_month: date,
+        cur_month: date,
+        hour: int,
+        limit: int = 2000,
+        data_source: str | None = None,
+        line_ref: str | None = None,
+        viewport: Viewport | None = None,
+    ) -> pa.Table:
+        if data_source is None:
+            prev = self._partition(prev_month, hour)
+            cur = self._partition(cur_month, hour)
+        else:
+            prev = self._data_source(prev_month, hour, data_source)
+            cur = self._data_source(cur_month, hour, data_source)
+        if line_ref is not None:
+            cur = self._on_line(cur, line_ref)
+        if viewport is not None:
+            cur = _in_view(cur, viewport)
+        if prev_month == cur_month:
+            cur = cur.slice(0, 0)
+
+        prev = prev.select(_leg_key + _comparison_metrics).rename_columns(
+            _leg_key + [f"prev_{col}" for col in _comparison_metrics]
+        )
+        joined = cur.join(prev, keys=_leg_key, join_type="inner")
+
+        net_change_seconds = pc.subtract(
+            pc.cast(joined["mean_hourly_duration"], pa.int32()),
+            pc.cast(joined["prev_mean_hourly_duration"], pa.int32()),
+        )
+        net_change_proportion = _to_int(
+            _divide(
+                pc.multiply(net_change_seconds, 100),
+                pc.add(
+                    pc.cast(joined["mean_hourly_duration"], pa.int32()),
+                    pc.cast(joined["prev_mean_hourly_duration"], pa.int32()),
+                ),
+            )
+        )
+        net_change_pct = _to_int(
+            _divide(
+                pc.multiply(net_change_seconds, 100), joined["prev_mean_hourly_duration"]
+            )
+        )
+        result = pa.table(
+            {
+                "name": joined["name"],
+                "net_change_seconds": net_change_seconds,
+                "net_change_proportion": net_change_proportion,
+                "net_change_pct": net_change_pct,
+                "from_stop": joined["from_stop"],
+                "to_stop": joined["to_stop"],
+                "air_distance_meters": joined["air_distance_meters"],
+                "from_lat": joined["from_lat"],
+                "from_lon": joined["from_lon"],
+                "to_lat": joined["to_lat"],
+                "to_lon": joined["to_lon"],
+                "lat": joined["lat"],
+                "lon": joined["lon"],
+                "cur_hourly_quartile": joined["hourly_quartile"],
+                "prev_hourly_quartile": joined["prev_hourly_quartile"],
+                "cur_hourly_duration": joined["hourly_duration"],
+                "prev_hourly_duration": joined["prev_hourly_duration"],
+                "cur_hourly_delay": joined["hourly_delay"],
+                "prev_hourly_delay": joined["prev_hourly_delay"],
+                "cur_hourly_deviation": joined["hourly_deviation"],
+                "prev_hourly_deviation": joined["prev_hourly_deviation"],
+                "cur_mean_hourly_duration": joined["mean_hourly_duration"],
+                "prev_mean_hourly_duration": joined["prev_mean_hourly_duration"],
+                "cur_month_count": joined["monthly_count"],
+                "prev_monthly_count": joined["prev_monthly_count"],
+                "cur_hourly_count": joined["hourly_count"],
+                "prev_hourly_count": joined["prev_hourly_count"],
+                "data_source": joined["data_source"],
+                "abs_net_change_proportion": pc.abs(net_change_proportion),
+            }
+        )
+        if viewport is not None:
+            result = _top_per_cell(
+                result.append_column("tile", joined["tile"]),
+                viewport,
+                "abs_net_change_proportion",
+            ).drop_columns(["tile"])
+        if data_source is None:
+            result = _top(result, limit, "abs_net_change_proportion")
+        return result.sort_by("abs_net_change_proportion")
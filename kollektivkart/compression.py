@@ -0,0 +1,74 @@
+"""
+Compress API responses by Accept-Encoding, and keep compressed responses in memory
+
+JSON responses from the API are columns of repetitive numbers and names, which compress
+very well. A response with a data version is always the same for the same url, so its
+compressed body is cached per encoding, and later requests for it skip the query, the
+serialization and the compression.
+"""
+
+import gzip
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+
+import brotli
+import zstandard
+
+# Smaller bodies are sent as they are, they fit in a packet anyway
+MIN_SIZE = 1024
+
+# Supported encodings, in order of preference when a client accepts several equally
+ENCODINGS: dict[str, Callable[[bytes], bytes]] = {
+    "zstd": lambda body: zstandard.compress(body, 6),
+    "br": lambda body: brotli.compress(body, quality=5),
+    "gzip": lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+}
+
+
+def negotiate(accepted: dict[str, float]) -> str | None:
+    """The best encoding of ENCODINGS by quality in accepted, None for no encoding"""
+    best, quality = None, 0.0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > quality:
+            best, quality = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return ENCODINGS[encoding](body)
+
+
+class ResponseCache:
+    """Compressed bodies by key, dropping the least recently used beyond max_bytes
+
+    Each process has a cache of its own.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._bodies: OrderedDict[Hashable, tuple[bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> tuple[bytes, str] | None:
+        """The body and content type stored for key, if any"""
+        with self._lock:
+            found = self._bodies.get(key)
+            if found is not None:
+                self._bodies.move_to_end(key)
+            return found
+
+    def put(self, key: Hashable, body: bytes, content_type: str):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._bodies.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._bodies[key] = (body, content_type)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (dropped, _) = self._bodies.popitem(last=False)
+                self._size -= len(dropped)
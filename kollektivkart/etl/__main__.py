@@ -10,7 +10,7 @@ import psutil
 import duckdb
 from google.cloud.bigquery import Client
 
-from . import sync, legs, leg_stats, mkdb
+from . import sync, legs, leg_stats, mkdb, static
 
 parser = ArgumentParser(
     description=__doc__, formatter_class=RawDescriptionHelpFormatter
@@ -42,6 +42,17 @@ parser.add_argument(
 parser.add_argument(
     "--skip-bq", action="store_true", help="Do not fetch new data in BigQuery"
 )
+parser.add_argument(
+    "--approx-quantiles",
+    action="store_true",
+    help="Use approximate medians and percentiles in leg stats, slower and with more memory than exact",
+)
+parser.add_argument(
+    "--static",
+    metavar="DEST",
+    help="Also render all API responses to a static tree in DEST, see etl.static",
+    type=str,
+)
 parser.add_argument(
     "data", help="Data repository, a folder or s3:// prefix to place output", type=str
 )
@@ -77,8 +88,16 @@ def main():
     if opts.invalidate:
         logging.info("Invalidate downstream of BQ")
     legs.run_job(db, root, opts.invalidate, from_date=from_date)
-    leg_stats.run_job(db, root, opts.invalidate, from_date=from_date)
+    leg_stats.run_job(
+        db,
+        root,
+        opts.invalidate,
+        from_date=from_date,
+        quantiles="approx" if opts.approx_quantiles else "exact",
+    )
     mkdb.run_job(root)
+    if opts.static:
+        static.run_job(root, opts.static, max_workers=opts.max_cpus)
 
 
 if __name__ == "__main__":
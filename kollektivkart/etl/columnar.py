@@ -0,0 +1,150 @@
+"""
+Export the serving data from stats.db as Arrow IPC files that the webapp can memory-map
+"""
+
+import logging
+import os
+from os.path import join
+
+import pyarrow as pa
+from duckdb import DuckDBPyConnection
+
+LEG_STATS = "leg_stats.arrow"
+LEG_STATS_INDEX = "leg_stats.index.arrow"
+STOP_LINE = "stop_line.arrow"
+STOP_LINE_INDEX = "stop_line.index.arrow"
+STOPS = "stops.arrow"
+
+# Same projection as queries.legs and the grid cell, rows for each (month, hour) sorted the way the API returns them
+_leg_stats_partition = """
+from leg_stats
+select
+  from_stop || ' to ' || to_stop as name,
+  from_stop,
+  to_stop,
+  air_distance_meters,
+  from_lat,
+  from_lon,
+  to_lat,
+  to_lon,
+  from_lat * .985 + to_lat * .015 as lat,
+  from_lon * .985 + to_lon * .015 as lon,
+  round(hourly_quartile / monthly_duration, 1) as rush_intensity,
+  hourly_quartile,
+  hourly_duration,
+  monthly_duration,
+  monthly_delay,
+  hourly_delay,
+  monthly_deviation,
+  hourly_deviation,
+  mean_hourly_duration,
+  mean_monthly_duration,
+  monthly_count,
+  hourly_count,
+  dataSource as data_source,
+  tile
+where month = $month and hour = $hour
+order by dataSource, rush_intensity
+"""
+
+_index_schema = pa.schema(
+    [
+        ("month", pa.date32()),
+        ("hour", pa.int32()),
+        ("data_source", pa.string()),
+        ("batch", pa.int32()),
+        ("offset", pa.int64()),
+        ("length", pa.int64()),
+    ]
+)
+
+_line_index_schema = pa.schema(
+    [("line_ref", pa.string()), ("offset", pa.int64()), ("length", pa.int64())]
+)
+
+
+def runs(column: pa.Array | pa.ChunkedArray) -> list[tuple[object, int, int]]:
+    """(value, offset, length) for each run of equal values in a sorted column"""
+    found: list[tuple[object, int, int]] = []
+    for offset, value in enumerate(column.to_pylist()):
+        if found and found[-1][0] == value:
+            prev, start, length = found[-1]
+            found[-1] = (prev, start, length + 1)
+        else:
+            found.append((value, offset, 1))
+    return found
+
+
+def write_leg_stats(db: DuckDBPyConnection, dest: str):
+    partitions = db.sql(
+        "select distinct month :: date, hour :: int4 from leg_stats order by all"
+    ).fetchall()
+    schema = (
+        db.execute(
+            f"{_leg_stats_partition} limit 0", parameters=dict(month=None, hour=None)
+        )
+        .to_arrow_table()
+        .schema
+    )
+    index: list[dict[str, object]] = []
+    with pa.ipc.new_file(join(dest, LEG_STATS), schema) as writer:
+        for batch_no, (month, hour) in enumerate(partitions):
+            table = db.execute(
+                _leg_stats_partition, parameters=dict(month=month, hour=hour)
+            ).to_arrow_table()
+            batch = table.combine_chunks().to_batches()[0]
+            for data_source, offset, length in runs(batch.column("data_source")):
+                index.append(
+                    dict(
+                        month=month,
+                        hour=hour,
+                        data_source=data_source,
+                        batch=batch_no,
+                        offset=offset,
+                        length=length,
+                    )
+                )
+            writer.write_batch(batch)
+    with pa.ipc.new_file(join(dest, LEG_STATS_INDEX), _index_schema) as out:
+        out.write_table(pa.Table.from_pylist(index, schema=_index_schema))
+
+
+def write_stop_line(db: DuckDBPyConnection, dest: str):
+    table = (
+        db.sql(
+            """
+        from stop_line
+        select lineRef as line_ref, dataSource as data_source, from_stop, to_stop
+        order by lineRef, dataSource, from_stop, to_stop
+        """
+        )
+        .to_arrow_table()
+        .combine_chunks()
+    )
+    with pa.ipc.new_file(join(dest, STOP_LINE), table.schema) as out:
+        out.write_table(table)
+    index = pa.Table.from_pylist(
+        [
+            dict(line_ref=line_ref, offset=offset, length=length)
+            for line_ref, offset, length in runs(table.column("line_ref"))
+        ],
+        schema=_line_index_schema,
+    )
+    with pa.ipc.new_file(join(dest, STOP_LINE_INDEX), _line_index_schema) as out:
+        out.write_table(index)
+
+
+def write_stops(db: DuckDBPyConnection, dest: str):
+    table = db.sql("from stops select name, lat, lon").to_arrow_table().combine_chunks()
+    with pa.ipc.new_file(join(dest, STOPS), table.schema) as out:
+        out.write_table(table)
+
+
+def write_serving_files(db: DuckDBPyConnection, dest: str):
+    os.makedirs(dest, exist_ok=True)
+    logging.info("Export leg stats as arrow to %s", dest)
+    write_leg_stats(db, dest)
+    logging.info("Export stop lines as arrow to %s", dest)
+    write_stop_line(db, dest)
+    logging.info("Export stops as arrow to %s", dest)
+    write_stops(db, dest)
@@ -52,11 +52,12 @@ def write_stop_line(db: DuckDBPyConnection, root: str):
     db.execute(_stop_line.format(dest=dest), parameters=dict(legs=legs))
 
 
-def leg_stats_partitions(db: DuckDBPyConnection, root, invalidate) -> set[date]:
+def monthly_partitions(
+    db: DuckDBPyConnection, root, dataset: str, invalidate
+) -> set[date]:
+    """Months of legs.parquet that dataset needs, the latest one and those it is missing"""
     available = available_monthly_partitions(db, join(root, "legs.parquet"))
-    have = available_monthly_partitions(
-        db, join(root, "leg_stats.parquet"), use_trunc=False
-    )
+    have = available_monthly_partitions(db, join(root, dataset), use_trunc=False)
     recalculate = {max(available)}
     need = recalculate | (available - have)
     if invalidate:
@@ -65,6 +66,25 @@ def leg_stats_partitions(db: DuckDBPyConnection, root, invalidate) -> set[date]:
         return need
 
 
+def leg_stats_partitions(db: DuckDBPyConnection, root, invalidate) -> set[date]:
+    return monthly_partitions(db, root, "leg_stats.parquet", invalidate)
+
+
+# The medians and 75th percentiles of _leg_stats, by the quantiles option of write_leg_stats.
+# exact is the one to use. Most (leg, hour) groups only have a few dozen values, so the
+# t-digest that approx_quantile keeps for each group is bigger than the values themselves,
+# and approx is both slower and uses more memory, see bench --quantile-accuracy.
+QUANTILES = {
+    "exact": """
+create or replace temporary macro leg_median(x) as median(x);
+create or replace temporary macro leg_quartile(x) as quantile_disc(x, .75);
+""",
+    "approx": """
+create or replace temporary macro leg_median(x) as approx_quantile(x, .5);
+create or replace temporary macro leg_quartile(x) as approx_quantile(x, .75);
+""",
+}
+
 _leg_stats = """
 with hourly as (
   from read_parquet($legs, hive_partitioning=true)
@@ -74,12 +94,10 @@ with hourly as (
     to_stop,
     date_trunc('month', operatingDate) as month,
     extract(hour from start_time) as hour,
-    quantile_disc(
-      actual_duration, .75
-    ) as hourly_quartile,
-    median(actual_duration) :: int2 as hourly_duration,
-    median(delay) :: int2 as hourly_delay,
-    median(deviation) :: int2 as hourly_deviation,
+    leg_quartile(actual_duration) as hourly_quartile,
+    leg_median(actual_duration) :: int2 as hourly_duration,
+    leg_median(delay) :: int2 as hourly_delay,
+    leg_median(deviation) :: int2 as hourly_deviation,
     mean(actual_duration) :: int2 as mean_hourly_duration,
     count(*) as hourly_count
   where
@@ -93,12 +111,10 @@ with hourly as (
     from_stop, 
     to_stop,
     date_trunc('month', operatingDate) as month,
-    median(actual_duration) :: int2 as monthly_duration,
-      quantile_disc(
-      actual_duration, .75
-    ) as monthly_quartile,
-    median(delay) :: int2 as monthly_delay,
-    median(deviation) :: int2 as monthly_deviation,
+    leg_median(actual_duration) :: int2 as monthly_duration,
+    leg_quartile(actual_duration) as monthly_quartile,
+    leg_median(delay) :: int2 as monthly_delay,
+    leg_median(deviation) :: int2 as monthly_deviation,
     mean(actual_duration) :: int2 as mean_monthly_duration,
     count(*) as monthly_count,
     any_value(air_distance_meters) as air_distance_meters,
@@ -117,18 +133,86 @@ where hourly_count > 20 and air_distance_meters > 50 and month = $month
 
 
 def write_leg_stats(
-    db: DuckDBPyConnection, root: str, invalidate: bool, from_date: date
+    db: DuckDBPyConnection,
+    root: str,
+    invalidate: bool,
+    from_date: date,
+    quantiles: str = "exact",
 ):
+    """Write leg_stats.parquet, with the quantiles used recorded in the metadata of each file"""
     partitions = leg_stats_partitions(db, root, invalidate)
     dest = join(root, "leg_stats.parquet")
     legs = join(root, "legs.parquet/*/*")
+    db.execute(QUANTILES[quantiles])
+    for partition in sorted(p for p in partitions if p >= from_date):
+        logging.info(
+            "Write leg stats for partition %s with %s quantiles",
+            partition.isoformat(),
+            quantiles,
+        )
+        query = f"COPY ({_leg_stats}) TO '{dest}' (format parquet, partition_by (month), overwrite_or_ignore, kv_metadata {{quantiles: '{quantiles}'}});"
+        db.execute(query, parameters=dict(month=partition, legs=legs))
+
+
+# The stops of each line and direction in order, from its most common sequence of stops
+# among the journeys in the month that have all their legs
+_line_stops = """
+with journeys as (
+  from read_parquet($legs, hive_partitioning=true)
+  select
+    dataSource,
+    lineRef,
+    direction,
+    list(from_stop order by sequenceNr) as from_stops,
+    list(to_stop order by sequenceNr) as to_stops
+  where date_trunc('month', operatingDate) = $month
+  group by dataSource, lineRef, direction, operatingDate, serviceJourneyId
+), patterns as (
+  from journeys
+  select
+    dataSource,
+    lineRef,
+    direction,
+    list_prepend(from_stops[1], to_stops) as stops
+  where list_slice(from_stops, 2, len(from_stops)) = list_slice(to_stops, 1, len(to_stops) - 1)
+), common as (
+  from patterns
+  select dataSource, lineRef, direction, stops, count(*) as journeys
+  group by dataSource, lineRef, direction, stops
+  qualify row_number() over (
+    partition by dataSource, lineRef, direction order by journeys desc, len(stops) desc, stops
+  ) = 1
+)
+from common
+select
+  dataSource,
+  lineRef,
+  direction,
+  $month :: date as month,
+  unnest(range(len(stops))) :: int2 as position,
+  unnest(stops) as stop
+"""
+
+
+def write_line_stops(
+    db: DuckDBPyConnection, root: str, invalidate: bool, from_date: date
+):
+    partitions = monthly_partitions(db, root, "line_stops.parquet", invalidate)
+    dest = join(root, "line_stops.parquet")
+    legs = join(root, "legs.parquet/*/*")
     for partition in sorted(p for p in partitions if p >= from_date):
-        logging.info("Write leg stats for partition %s", partition.isoformat())
-        query = f"COPY ({_leg_stats}) TO '{dest}' (format parquet, partition_by (month), overwrite_or_ignore);"
+        logging.info("Write line stops for partition %s", partition.isoformat())
+        query = f"COPY ({_line_stops}) TO '{dest}' (format parquet, partition_by (month), overwrite_or_ignore);"
         db.execute(query, parameters=dict(month=partition, legs=legs))
 
 
-def run_job(db: DuckDBPyConnection, root: str, invalidate: bool, from_date: date):
+def run_job(
+    db: DuckDBPyConnection,
+    root: str,
+    invalidate: bool,
+    from_date: date,
+    quantiles: str = "exact",
+):
     logging.info("Write datasources")
     write_datasources(db, root)
     logging.info("Write stops for lines")
@@ -136,4 +220,6 @@ def run_job(db: DuckDBPyConnection, root: str, invalidate: bool, from_date: date
     logging.info("Write datasource lines")
     write_datasource_lines(db, root)
     logging.info("Write leg stats")
-    write_leg_stats(db, root, invalidate, from_date.replace(day=1))
+    write_leg_stats(db, root, invalidate, from_date.replace(day=1), quantiles)
+    logging.info("Write line stops")
+    write_line_stops(db, root, invalidate, from_date.replace(day=1))
@@ -4,12 +4,16 @@ Make a duckdb file from aggregated stats
 
 import os
 import logging
+import shutil
 
 import tempfile
 
 import duckdb
 from duckdb import DuckDBPyConnection
 
+from . import columnar
+from .legs import create_stopdata
+
 _arrivals_stat = """
 select
     min(operatingDate) as min_date,
@@ -19,34 +23,225 @@ from read_parquet($parquet, hive_partitioning=true)
 """
 
 
+# Zoom level of the grid that legs are indexed by, about 300m x 300m cells in Norway
+GRID_ZOOM = 16
+
+# tile_key is the Z-order (Morton) code of the web mercator tile at GRID_ZOOM containing a
+# point, made by interleaving the bits of its x and y. Cells at zoom z < GRID_ZOOM are
+# tile >> 2 * (GRID_ZOOM - z), and sorting by it keeps nearby legs together
+_tile_key = f"""
+create temp macro spread_8(v) as (v | (v << 8)) & 16711935;  -- 0x00ff00ff
+create temp macro spread_4(v) as (v | (v << 4)) & 252645135;  -- 0x0f0f0f0f
+create temp macro spread_2(v) as (v | (v << 2)) & 858993459;  -- 0x33333333
+create temp macro spread_1(v) as (v | (v << 1)) & 1431655765;  -- 0x55555555
+create temp macro spread(v) as spread_1(spread_2(spread_4(spread_8(v))));
+create temp macro tile_x(lon) as
+  least(greatest(floor((lon + 180) / 360 * {2**GRID_ZOOM}), 0), {2**GRID_ZOOM - 1}) :: int64;
+create temp macro tile_y(lat) as
+  least(greatest(
+    floor((1 - ln(tan(radians(lat)) + 1 / cos(radians(lat))) / pi()) / 2 * {2**GRID_ZOOM}),
+  0), {2**GRID_ZOOM - 1}) :: int64;
+create temp macro tile_key(lat, lon) as
+  (spread(tile_x(lon)) | (spread(tile_y(lat)) << 1)) :: uint32;
+"""
+
+
+# leg_stats is sorted by month, so looking up one leg in it reads the whole table. This copy
+# is sorted by leg, so the zonemaps of its row groups let DuckDB skip all but a few of them
+_leg_history = """
+create table leg_history as
+from leg_stats
+select
+  dataSource,
+  from_stop,
+  to_stop,
+  month,
+  hour,
+  hourly_quartile,
+  hourly_duration,
+  monthly_duration,
+  monthly_delay,
+  hourly_delay,
+  monthly_deviation,
+  hourly_deviation,
+  mean_hourly_duration,
+  mean_monthly_duration,
+  monthly_count,
+  hourly_count
+order by dataSource, from_stop, to_stop, month, hour
+"""
+
+
+# Running totals of the typical (median) and 75th percentile durations of the legs along each
+# line and direction, for each month and hour, so the time between two of its stops is a
+# difference of two rows. These are sums of per-leg statistics, not statistics of whole trips.
+# Legs without stats in an hour count as 0 and in missing_legs, which must not change between
+# the two stops for the difference to mean anything
+_line_travel_time = """
+create table line_travel_time as
+with line_stops as (
+  from read_parquet('{parquet_location}/line_stops.parquet/*/*', hive_partitioning=true)
+  select dataSource, lineRef, direction, month :: date as month, position, stop
+), line_legs as (
+  from line_stops s join line_stops prev
+    on s.dataSource = prev.dataSource and s.lineRef = prev.lineRef
+      and s.direction = prev.direction and s.month = prev.month
+      and s.position = prev.position + 1
+  select s.dataSource, s.lineRef, s.direction, s.month, s.position, prev.stop as from_stop, s.stop as to_stop
+), line_hours as (
+  from line_legs join leg_stats using (dataSource, from_stop, to_stop, month)
+  select distinct dataSource, lineRef, direction, month, hour :: int4 as hour
+)
+from line_hours
+  join line_stops using (dataSource, lineRef, direction, month)
+  left join line_legs using (dataSource, lineRef, direction, month, position)
+  left join leg_stats using (dataSource, from_stop, to_stop, month, hour)
+select
+  dataSource,
+  lineRef,
+  direction,
+  month,
+  hour,
+  position,
+  stop,
+  sum(coalesce(hourly_duration, 0)) over running :: int4 as duration,
+  sum(coalesce(hourly_quartile, 0)) over running :: int4 as quartile,
+  count(*) filter (position > 0 and hourly_duration is null) over running :: int2 as missing_legs
+window running as (
+  partition by dataSource, lineRef, direction, month, hour order by position
+)
+order by dataSource, lineRef, month, hour, direction, position
+"""
+
+
+# The legs of each line, sorted by line so that the zonemaps of its row groups let a filter
+# on one line skip all but a few of them. See queries._of_line
+_line_leg = """
+create table line_leg as
+from stop_line
+select distinct dataSource, lineRef, from_stop, to_stop
+order by dataSource, lineRef, from_stop, to_stop
+"""
+
+
+# Stop places that legs go to or from, for the stop search in the webapp
+_stops = """
+create table stops as
+with used as (
+  from leg_stats select from_stop as name union from leg_stats select to_stop
+)
+from stopdata semi join used using (name)
+select stop_id, name, avg(lat) as lat, avg(lon) as lon
+group by stop_id, name
+order by name, stop_id
+"""
+
+
+# Whether the medians and percentiles of each month are exact or approximate, from the
+# metadata that leg_stats.write_leg_stats puts in each file. Older files are exact.
+_leg_stats_quantiles = """
+create table leg_stats_quantiles as
+with files as (
+  from read_parquet('{parquet_location}/leg_stats.parquet/*/*', hive_partitioning=true, filename=true)
+  select distinct month :: date as month, filename
+), modes as (
+  from parquet_kv_metadata('{parquet_location}/leg_stats.parquet/*/*')
+  select file_name as filename, decode(value) as quantiles
+  where decode(key) = 'quantiles'
+)
+from files left join modes using (filename)
+select month, if(bool_or(quantiles = 'approx'), 'approx', 'exact') as quantiles
+group by month
+order by month
+"""
+
+
+# Content hashes, so rebuilding with the same data gives the same versions. A month
+# depends on its leg stats, the lines of its legs and their travel times, the build on everything,
+# including the stops that the serving stops file and /api/stops come from
+_data_version = """
+create table data_version as
+with legs as (
+  from leg_stats l select month, sum(hash(l)) as h group by month
+), lines as (
+  from (select distinct month, dataSource, from_stop, to_stop from leg_stats) legs
+    join stop_line s using (dataSource, from_stop, to_stop)
+  select month, sum(hash(s)) as h
+  group by month
+), travel as (
+  from line_travel_time t select month, sum(hash(t)) as h group by month
+), months as (
+  from legs left join lines using (month) left join travel on legs.month = travel.month
+  select
+    legs.month :: date as month,
+    hash(legs.h, coalesce(lines.h, 0), coalesce(travel.h, 0)) as h
+)
+select month, lower(hex(h)) as version from months
+union all
+select null, lower(hex(hash(
+  (from months select sum(h)),
+  (from datasources d select sum(hash(d))),
+  (from datasource_line d select sum(hash(d))),
+  (from arrivals_stats a select sum(hash(a))),
+  (from stops s select sum(hash(s)))
+)))
+"""
+
+
 def make_tables(dest_db: DuckDBPyConnection, parquet_location: str):
+    dest_db.execute(_tile_key)
     dest_db.execute(
-        f"create table leg_stats as from read_parquet('{parquet_location}/leg_stats.parquet/*/*', hive_partitioning=true) select * order by month, hour, dataSource"
+        f"create table leg_stats as from read_parquet('{parquet_location}/leg_stats.parquet/*/*', hive_partitioning=true) select *, tile_key(from_lat, from_lon) as tile order by month, hour, dataSource, tile"
     )
+    dest_db.execute(_leg_stats_quantiles.format(parquet_location=parquet_location))
+    dest_db.execute(_leg_history)
+    dest_db.execute(_line_travel_time.format(parquet_location=parquet_location))
+    create_stopdata(dest_db, parquet_location)
+    dest_db.execute(_stops)
     dest_db.execute(f"""
     create table datasources as from '{parquet_location}/datasources.parquet' join leg_stats using(dataSource) select distinct dataSource, dataSourceName;
     create table datasource_line as from '{parquet_location}/datasource_line.parquet';
     create table stop_line as from '{parquet_location}/stop_line.parquet';
     """)
+    dest_db.execute(_line_leg)
     parquet = os.path.join(parquet_location, "arrivals.parquet/*/*")
     dest_db.execute(
         f"create table arrivals_stats as {_arrivals_stat}",
         parameters=dict(parquet=parquet),
     )
+    dest_db.execute(_data_version)
+
+
+def publish_serving_files(serving_dir: str, root: str):
+    dest = os.path.join(root, "serving")
+    old = None
+    if os.path.exists(dest):
+        old = tempfile.mkdtemp(dir=root)
+        os.rename(dest, os.path.join(old, "serving"))
+    os.rename(serving_dir, dest)
+    logging.info("Placed new serving files at %s", dest)
+    if old is not None:
+        shutil.rmtree(old)
 
 
 def run_job(root: str):
     (fd, db_f) = tempfile.mkstemp(suffix=".db", dir=root)
     os.close(fd)
     os.unlink(db_f)
+    serving_dir = tempfile.mkdtemp(suffix=".serving", dir=root)
+    os.chmod(serving_dir, 0o755)
     db = duckdb.connect(db_f)
     logging.info("Created new duckdb file at %s", db_f)
     try:
         make_tables(db, root)
+        columnar.write_serving_files(db, serving_dir)
         db.close()
 
         os.rename(db_f, os.path.join(root, "stats.db"))
         logging.info("Placed new duckdb file at %s", os.path.join(root, "stats.db"))
+        publish_serving_files(serving_dir, root)
     finally:
         if os.path.exists(db_f):
             os.unlink(db_f)
+        if os.path.exists(serving_dir):
+            shutil.rmtree(serving_dir)
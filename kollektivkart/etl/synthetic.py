@@ -0,0 +1,177 @@
+"""
+Generate synthetic arrivals.parquet, stops.parquet and quays.parquet, shaped like the data from etl.sync
+
+The data has the columns and partitioning that the sync job writes, so it can stand in for
+BigQuery when timing the ETL and the API, see kollektivkart.bench. Stops lie on a grid about
+450m apart in Oslo, and each line visits a run of consecutive stops, sharing half of them with
+the next line. Journeys run in both directions between 05:00 and 23:00, are slower in rush
+hours and get some noise. All of it is derived from hashes of the seed, so the same options
+always give the same data.
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+from datetime import date, timedelta
+from os.path import join
+
+from duckdb import DuckDBPyConnection
+
+# Stops are placed along the rows of a grid this many stops wide, snaking back and forth,
+# so that consecutive stops are always neighbours
+_GRID_WIDTH = 50
+
+
+@dataclass(frozen=True)
+class Scale:
+    start: date = date(2024, 1, 15)
+    days: int = 35
+    lines: int = 30
+    # Journeys of each line, in each direction, each day
+    journeys: int = 40
+    stops_per_line: int = 20
+    data_sources: int = 2
+    seed: int = 0
+
+    @property
+    def stops(self) -> int:
+        return (self.lines - 1) * (self.stops_per_line // 2) + self.stops_per_line
+
+    @property
+    def arrivals_per_day(self) -> int:
+        return self.lines * 2 * self.journeys * self.stops_per_line
+
+
+_stops = """
+from range($stops) t(i)
+select
+  i,
+  i // $width as row,
+  case when row % 2 = 0 then i % $width else $width - 1 - i % $width end as col,
+  59.85 + row * .004 :: double as lat,
+  10.60 + col * .008 :: double as lon
+"""
+
+_write_stops = f"""
+COPY (
+  from ({_stops})
+  select
+    'NSR:StopPlace:' || i as id,
+    '1' as version,
+    null :: varchar as publicCode,
+    'bus' as transportMode,
+    'Synthetic stop ' || i as name,
+    lon as location_longitude,
+    lat as location_latitude
+) TO '{{dest}}' (format parquet, overwrite);
+"""
+
+_write_quays = f"""
+COPY (
+  from ({_stops}), range(2) q(quay)
+  select
+    'NSR:Quay:' || i || '-' || quay as id,
+    '1' as version,
+    (quay + 1) :: varchar as publicCode,
+    null :: varchar as name,
+    lon + (quay - .5) * .0002 :: double as location_longitude,
+    lat as location_latitude,
+    'NSR:StopPlace:' || i as stopPlaceRef
+) TO '{{dest}}' (format parquet, overwrite);
+"""
+
+# One row per call of each journey on $day. A leg takes between 45 and 165 seconds as planned,
+# 35% longer in rush hours, and every journey starts with a delay between -30 and 90 seconds.
+# About one journey in 200 is cancelled and every 10th call refers to the stop place and not a quay.
+_arrivals = """
+with journeys as (
+  from range($lines) l(line), range(2) d(direction), range($journeys) j(journey)
+  select
+    line,
+    direction,
+    journey,
+    line % $data_sources as source,
+    line * ($stops_per_line // 2) as first_stop,
+    ($day :: timestamp AT TIME ZONE 'Europe/Oslo')
+      + to_seconds(5 * 3600 + (journey * 18 * 3600) // $journeys + (line * 97) % 600) as departure,
+    (hash($seed, $day, line, direction, journey) % 120) :: int - 30 as initial_delay,
+    hash($seed, $day, line, direction, journey, 'cancel') % 200 = 0 as cancelled
+), calls as (
+  from journeys, range($stops_per_line) s(position)
+  select
+    *,
+    first_stop + if(direction = 0, position, $stops_per_line - 1 - position) as stop,
+    stop + if(direction = 0, -1, 1) as previous_stop,
+    extract(hour from departure) in (7, 8, 15, 16) as rush,
+    if(position = 0, 0, 45 + hash(least(stop, previous_stop), greatest(stop, previous_stop)) % 120) :: int as planned,
+    if(position = 0, 0, greatest(
+      2,
+      planned * if(rush, 1.35, 1.0) + (hash($seed, $day, line, direction, journey, position) % 41) :: int - 15
+    )) :: int as actual
+), timed as (
+  from calls
+  select
+    *,
+    departure + to_seconds(sum(planned) over journey + 20 * position) as aimed,
+    departure + to_seconds(initial_delay + sum(actual) over journey + 20 * position) as actual_time
+  window journey as (
+    partition by line, direction, journey order by position rows unbounded preceding
+  )
+)
+from timed
+select
+  actual_time + to_seconds(if(position = $stops_per_line - 1, 30, 50)) as recordedAtTime,
+  'SYN' || source || ':Line:' || line as lineRef,
+  if(direction = 0, 'outbound', 'inbound') as directionRef,
+  $day :: date as operatingDate,
+  'SYN' || source || ':ServiceJourney:' || line || '-' || direction || '-' || journey as serviceJourneyId,
+  'SYN' || source || ':Operator:1' as operatorRef,
+  false as extraJourney,
+  cancelled as journeyCancellation,
+  if(hash(stop, direction) % 10 = 0, 'NSR:StopPlace:' || stop, 'NSR:Quay:' || stop || '-' || direction) as stopPointRef,
+  position + 1 as sequenceNr,
+  'Synthetic stop ' || if(direction = 0, first_stop, first_stop + $stops_per_line - 1) as originName,
+  'Synthetic stop ' || if(direction = 0, first_stop + $stops_per_line - 1, first_stop) as destinationName,
+  false as extraCall,
+  false as stopCancellation,
+  if(position = 0, null, aimed) as aimedArrivalTime,
+  if(position = 0, null, actual_time) as arrivalTime,
+  if(position = $stops_per_line - 1, null, aimed + to_seconds(20)) as aimedDepartureTime,
+  if(position = $stops_per_line - 1, null, actual_time + to_seconds(20)) as departureTime,
+  'SYN' || source as dataSource,
+  'Synthetic ' || source as dataSourceName,
+  false as estimated
+"""
+
+
+def write_stops(db: DuckDBPyConnection, root: str, scale: Scale):
+    params = dict(stops=scale.stops, width=_GRID_WIDTH)
+    db.execute(_write_stops.format(dest=join(root, "stops.parquet")), parameters=params)
+    db.execute(_write_quays.format(dest=join(root, "quays.parquet")), parameters=params)
+
+
+def write_arrivals(db: DuckDBPyConnection, root: str, scale: Scale, day: date):
+    dest = join(root, "arrivals.parquet")
+    db.execute(
+        f"COPY ({_arrivals}) TO '{dest}' (format parquet, partition_by (operatingDate), overwrite_or_ignore);",
+        parameters=dict(
+            day=day,
+            lines=scale.lines,
+            journeys=scale.journeys,
+            stops_per_line=scale.stops_per_line,
+            data_sources=scale.data_sources,
+            seed=scale.seed,
+        ),
+    )
+
+
+def run_job(db: DuckDBPyConnection, root: str, scale: Scale):
+    os.makedirs(root, exist_ok=True)
+    logging.info("Write %d synthetic stops to %s", scale.stops, root)
+    write_stops(db, root, scale)
+    for i in range(scale.days):
+        day = scale.start + timedelta(days=i)
+        logging.info(
+            "Write %d synthetic arrivals for %s", scale.arrivals_per_day, day.isoformat()
+        )
+        write_arrivals(db, root, scale, day)
@@ -0,0 +1,227 @@
+"""
+Stream large extracts of leg_stats or legs.parquet as Arrow IPC streams or Parquet files
+
+Rows come from DuckDB in record batches, so memory use is bounded by the batch size and not
+by the size of the extract. While an extract streams, it is also written to a cache folder,
+and complete extracts are served from there with support for Range requests, which lets
+clients resume interrupted downloads. An extract is finished even if its first download
+is interrupted.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from collections.abc import Iterator
+from dataclasses import astuple, dataclass
+from datetime import date
+from os.path import join
+from typing import BinaryIO
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from duckdb import DuckDBPyConnection
+
+from . import queries
+
+ROWS_PER_BATCH = 65536
+
+# Content type and file extension of each format
+FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", ".arrows"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+
+@dataclass(frozen=True)
+class Extract:
+    dataset: str
+    start: date
+    end: date
+    data_source: str | None
+    line_ref: str | None
+    format: str
+
+    @property
+    def content_type(self) -> str:
+        return FORMATS[self.format][0]
+
+    def filename(self, version: str) -> str:
+        digest = hashlib.sha256(repr(astuple(self)).encode()).hexdigest()[:24]
+        return f"{version}-{digest}{FORMATS[self.format][1]}"
+
+
+class _Chunks(io.RawIOBase):
+    """A write-only file that hands out what was written to it since last time"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def encode(reader: pa.RecordBatchReader, format: str) -> Iterator[bytes]:
+    sink = _Chunks()
+    writer = (
+        pa.ipc.new_stream(sink, reader.schema)
+        if format == "arrow"
+        else pq.ParquetWriter(sink, reader.schema, compression="zstd")
+    )
+    with writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            yield sink.take()
+    yield sink.take()
+
+
+def rows(db: DuckDBPyConnection, root: str, extract: Extract) -> pa.RecordBatchReader:
+    if extract.dataset == "legs":
+        return queries.export_legs(
+            db,
+            join(root, "legs.parquet/*/*"),
+            extract.start,
+            extract.end,
+            extract.data_source,
+            extract.line_ref,
+            ROWS_PER_BATCH,
+        )
+    return queries.export_leg_stats(
+        db,
+        extract.start,
+        extract.end,
+        extract.data_source,
+        extract.line_ref,
+        ROWS_PER_BATCH,
+    )
+
+
+class ExportCache:
+    """Complete extracts by data version, only extracts of the current version are kept
+
+    Beyond max_bytes, the least recently used extracts are removed. A hit touches the
+    modification time of its file, which is what least recently used goes by.
+    """
+
+    def __init__(self, root: str, location: str, max_bytes: int):
+        self.root = root
+        self.location = location
+        self.max_bytes = max_bytes
+        os.makedirs(location, exist_ok=True)
+
+    def find(self, extract: Extract, version: str) -> str | None:
+        path = join(self.location, extract.filename(version))
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _evict(self, version: str):
+        kept: list[tuple[float, int, str]] = []
+        for entry in os.scandir(self.location):
+            if entry.name.startswith("."):
+                continue
+            try:
+                if not entry.name.startswith(f"{version}-"):
+                    os.unlink(entry.path)
+                else:
+                    stat = entry.stat()
+                    kept.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+        kept.sort(reverse=True)
+        size = sum(size for _, size, _ in kept)
+        # The most recent extract stays, even when it is bigger than max_bytes on its own
+        for _, file_size, path in kept[1:][::-1]:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def _publish(self, partial: str, extract: Extract, version: str):
+        os.chmod(partial, 0o644)
+        os.replace(partial, join(self.location, extract.filename(version)))
+        self._evict(version)
+
+    def _finish(
+        self,
+        db: DuckDBPyConnection,
+        chunks: Iterator[bytes],
+        out: BinaryIO,
+        partial: str,
+        extract: Extract,
+        version: str,
+    ):
+        """Write the rest of an extract that the client stopped reading, so it can resume"""
+        try:
+            with out:
+                for chunk in chunks:
+                    out.write(chunk)
+            self._publish(partial, extract, version)
+            logging.info("Finished export %s after the client left", extract)
+        except Exception:
+            logging.exception("Failed to finish export %s", extract)
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            db.close()
+
+    def stream(
+        self,
+        db: DuckDBPyConnection,
+        extract: Extract,
+        version: str | None,
+    ) -> Iterator[bytes]:
+        """Stream extract from db, and keep it when it is complete
+
+        If the client disconnects, the extract is finished on a thread of its own, so
+        that a retry can resume it from the cache. db is closed when the extract is
+        done, so it should be a cursor of its own.
+        """
+        fd, partial = tempfile.mkstemp(dir=self.location, prefix=".partial-")
+        out = os.fdopen(fd, "wb")
+        chunks = encode(rows(db, self.root, extract), extract.format)
+        handed_off = False
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                yield chunk
+            out.close()
+            if version is not None:
+                self._publish(partial, extract, version)
+        except GeneratorExit:
+            if version is not None:
+                threading.Thread(
+                    target=self._finish,
+                    args=(db, chunks, out, partial, extract, version),
+                    name="export",
+                    daemon=True,
+                ).start()
+                handed_off = True
+            raise
+        finally:
+            if not handed_off:
+                out.close()
+                if os.path.exists(partial):
+                    os.unlink(partial)
+                db.close()
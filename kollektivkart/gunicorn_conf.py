@@ -0,0 +1,24 @@
+"""
+gunicorn settings for the webapp, use them with:
+
+gunicorn -c python:kollektivkart.gunicorn_conf kollektivkart.webapp:server
+
+The app is imported once before forking. Each worker opens stats.db, the columnar store
+and the stop index after the fork, so a worker started after an ETL run serves the new
+data, and starts warming up right away. /ready answers 503 until it is done.
+"""
+
+preload_app = True
+
+
+def post_fork(_server, _worker):
+    from kollektivkart import webapp
+
+    webapp.start_warming()
+
+
+def worker_exit(_server, _worker):
+    from kollektivkart import webapp
+
+    # DuckDB aborts the process if it exits in the middle of a query
+    webapp.warmed.wait(timeout=10)
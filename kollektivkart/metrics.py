@@ -0,0 +1,272 @@
+"""
+Prometheus metrics and an opt-in log of slow queries for the webapp
+
+Metrics are kept per process, so with several gunicorn workers each scrape of /metrics
+sees the worker that answered it. Every sample has a worker label to tell them apart.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator, Sequence
+from datetime import datetime, timezone
+from typing import ParamSpec, TypeVar
+
+from duckdb import DuckDBPyConnection
+
+_latency_buckets = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+_size_buckets = tuple(4.0**n * 1024 for n in range(8))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], **extra: str) -> str:
+    pairs = [("worker", str(os.getpid())), *zip(names, values), *extra.items()]
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(
+        self, name: str, doc: str, labels: Sequence[str], buckets: Sequence[float]
+    ):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> per-bucket counts, followed by the sum and total count
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts = self._values.setdefault(
+                labels, [0.0] * (len(self.buckets) + 2)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        for labels, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = _labels(self.labels, labels, le=repr(bound))
+                yield f"{self.name}_bucket{le} {count:.0f}"
+            inf = _labels(self.labels, labels, le="+Inf")
+            yield f"{self.name}_bucket{inf} {counts[-1]:.0f}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {counts[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {counts[-1]:.0f}"
+
+
+class Gauge:
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def add(self, amount: float):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name}{_labels((), ())} {self._value}"
+
+
+request_seconds = Histogram(
+    "kollektivkart_request_duration_seconds",
+    "Time spent handling requests",
+    ("route", "status"),
+    _latency_buckets,
+)
+response_bytes = Histogram(
+    "kollektivkart_response_size_bytes",
+    "Size of response bodies",
+    ("route",),
+    _size_buckets,
+)
+query_seconds = Histogram(
+    "kollektivkart_query_duration_seconds",
+    "Time spent executing queries, by statement",
+    ("statement",),
+    _latency_buckets,
+)
+serialization_seconds = Histogram(
+    "kollektivkart_serialization_duration_seconds",
+    "Time spent encoding query results as JSON",
+    ("route",),
+    _latency_buckets,
+)
+in_flight = Gauge("kollektivkart_requests_in_flight", "Requests being handled")
+duckdb_memory = Gauge(
+    "kollektivkart_duckdb_memory_bytes", "Memory used by DuckDB in this worker"
+)
+
+_registry = [
+    request_seconds,
+    response_bytes,
+    query_seconds,
+    serialization_seconds,
+    in_flight,
+    duckdb_memory,
+]
+
+
+def expose() -> str:
+    return "\n".join(line for metric in _registry for line in metric.expose()) + "\n"
+
+
+class SlowQueries:
+    """Keep the most recent queries slower than threshold, along with EXPLAIN ANALYZE
+
+    The query is analyzed again on a separate cursor in a background thread, so this
+    doubles the cost of slow queries. Only one query is analyzed at a time, and slow
+    queries that come in meanwhile are not captured. It is off unless size is positive.
+    """
+
+    def __init__(self, size: int, threshold: float):
+        self.threshold = threshold
+        # Seconds of each captured query, for sorting, along with what /slow-queries shows
+        self._captured: deque[tuple[float, dict[str, object]]] = deque(
+            maxlen=max(size, 1)
+        )
+        self._enabled = size > 0
+        self._analyzing = threading.Lock()
+
+    def wants(self, seconds: float) -> bool:
+        return self._enabled and seconds >= self.threshold
+
+    def capture(
+        self,
+        db: DuckDBPyConnection,
+        name: str,
+        sql: str,
+        params: dict[str, object],
+        seconds: float,
+    ):
+        if not self._analyzing.acquire(blocking=False):
+            return
+        try:
+            cursor = db.cursor()
+            captured_at = datetime.now(timezone.utc).isoformat()
+            threading.Thread(
+                target=self._analyze,
+                args=(cursor, name, sql, params, seconds, captured_at),
+                daemon=True,
+            ).start()
+        except BaseException:
+            self._analyzing.release()
+            raise
+
+    def _analyze(
+        self,
+        cursor: DuckDBPyConnection,
+        name: str,
+        sql: str,
+        params: dict[str, object],
+        seconds: float,
+        captured_at: str,
+    ):
+        try:
+            plan = "\n".join(
+                row[1]
+                for row in cursor.execute(
+                    f"explain analyze {sql}", params or None
+                ).fetchall()
+            )
+        except Exception as e:
+            logging.warning("Unable to analyze slow query %s: %s", name, e)
+            plan = None
+        finally:
+            cursor.close()
+            self._analyzing.release()
+        self._captured.append(
+            (
+                seconds,
+                dict(
+                    statement=name,
+                    params={
+                        k: str(v) if v is not None else None for k, v in params.items()
+                    },
+                    seconds=seconds,
+                    captured_at=captured_at,
+                    plan=plan,
+                ),
+            )
+        )
+
+    def slowest(self) -> list[dict[str, object]]:
+        return [
+            query
+            for _, query in sorted(self._captured, key=lambda q: q[0], reverse=True)
+        ]
+
+
+slow_queries = SlowQueries(
+    size=int(os.environ.get("SLOW_QUERY_LOG", "0")),
+    threshold=float(os.environ.get("SLOW_QUERY_SECONDS", "0.25")),
+)
+
+
+def observe_query(
+    db: DuckDBPyConnection,
+    name: str,
+    sql: str,
+    params: dict[str, object],
+    started: float,
+):
+    seconds = time.perf_counter() - started
+    query_seconds.observe(seconds, name)
+    if slow_queries.wants(seconds):
+        slow_queries.capture(db, name, sql, params, seconds)
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def timed(name: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """Record calls to the decorated function in query_seconds, for queries not in DuckDB"""
+
+    def decorate(fn: Callable[P, R]) -> Callable[P, R]:
+        @functools.wraps(fn)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                query_seconds.observe(time.perf_counter() - started, name)
+
+        return wrapper
+
+    return decorate
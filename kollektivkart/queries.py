@@ -1,53 +1,203 @@
-import pandas as pd
+import math
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import pyarrow as pa
 from datetime import date
+import duckdb
 from duckdb import DuckDBPyConnection
 
+from . import metrics
+from .etl.mkdb import GRID_ZOOM
+
+# DuckDB imports pandas for .df() when it is needed, see api
+if TYPE_CHECKING:
+    import pandas as pd
+
+# The fixed statements of the API, prepared once per connection on first use, see execute
+_statements: dict[str, str] = {}
+
+
+def _statement(name: str, sql: str) -> str:
+    _statements[name] = sql
+    return name
+
+
+class InvalidParameter(ValueError):
+    """A parameter that can not be used in a query, the API answers 400 for these"""
+
+
+def _literal(value: object) -> str:
+    if value is None:
+        return "NULL"
+    elif isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    elif isinstance(value, float) and not math.isfinite(value):
+        raise InvalidParameter(f"{value!r} is not a finite number")
+    elif isinstance(value, (int, float)):
+        return repr(value)
+    elif isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    elif isinstance(value, str) and "\x00" in value:
+        # The statement is SQL text, and DuckDB can not parse a NUL byte in it
+        raise InvalidParameter(f"{value!r} contains a NUL byte")
+    elif isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise TypeError(f"Can not use {value!r} as a prepared statement parameter")
+
+
+def execute(db: DuckDBPyConnection, name: str, **params) -> DuckDBPyConnection:
+    """Execute the statement registered as name, preparing it on db if necessary
+
+    DuckDB only keeps prepared statements for the connection (cursor) that prepared them,
+    so this pays off for long-lived cursors, like the ones in webapp.CursorPool.
+    """
+    args = ", ".join(f'"{key}" := {_literal(value)}' for key, value in params.items())
+    statement = f"execute {name}({args})" if params else f"execute {name}"
+    started = time.perf_counter()
+    try:
+        result = db.execute(statement)
+    except duckdb.BinderException as e:
+        if f'"{name}" does not exist' not in str(e):
+            raise
+        db.execute(f"prepare {name} as {_statements[name]}")
+        result = db.execute(statement)
+    metrics.observe_query(db, name, _statements[name], params, started)
+    return result
+
+
+_datasources_by_name = _statement(
+    "datasources_by_name",
+    """
+        select dataSourceName, dataSource 
+        from datasources 
+        where dataSource != 'SOF' 
+        order by dataSourceName""",
+)
+
 
 def datasources_by_name(db: DuckDBPyConnection) -> dict[str, str]:
     return {
         row[1]: row[0]
         for row
         # TODO: Fix SOF differently
-        in db.query("""
-        select dataSourceName, dataSource 
-        from datasources 
-        where dataSource != 'SOF' 
-        order by dataSourceName""").fetchall()
+        in execute(db, _datasources_by_name).fetchall()
     }
 
 
+_lines_for_datasource = _statement(
+    "lines_for_datasource",
+    """select lineRef from datasource_line 
+               where dataSource = $data_source 
+               order by cast(regexp_extract(lineRef, '(\\d+)$') as int)""",
+)
+
+
 def lines_for_datasource(db: DuckDBPyConnection, data_source: str) -> dict[str, str]:
     return {
         row[0].split(":")[-1]: row[0]
-        for row in db.query(
-            """select lineRef from datasource_line 
-               where dataSource = $data_source 
-               order by cast(regexp_extract(lineRef, '(\\d+)$') as int)""",
-            params=dict(data_source=data_source),
+        for row in execute(
+            db, _lines_for_datasource, data_source=data_source
         ).fetchall()
     }
 
 
+_data_versions = _statement(
+    "data_versions", "select month :: date, version from data_version"
+)
+
+
+def data_versions(db: DuckDBPyConnection) -> dict[date | None, str]:
+    """Content versions of each month in leg_stats, and of the whole build as None"""
+    try:
+        return dict(execute(db, _data_versions).fetchall())
+    except duckdb.CatalogException:
+        return {}
+
+
+_months = _statement(
+    "months", "select distinct month :: date from leg_stats order by month asc"
+)
+
+
 def months(db: DuckDBPyConnection) -> list[date]:
-    return [
-        row[0]
-        for row in db.query(
-            "select distinct month :: date from leg_stats order by month asc"
-        ).fetchall()
-    ]
+    return [row[0] for row in execute(db, _months).fetchall()]
 
 
-def legs(
-    db: DuckDBPyConnection,
-    month: date,
-    hour: int,
-    data_source: str,
-    line_ref: str | None = None,
-) -> pd.DataFrame:
-    return (
-        db.sql(
-            """
-SELECT distinct on (from_stop, to_stop, dataSource)
+_quantiles = _statement(
+    "quantiles", "from leg_stats_quantiles select month, quantiles order by month"
+)
+
+
+def quantiles(db: DuckDBPyConnection) -> dict[date, str]:
+    """exact or approx for each month, by how its medians and percentiles were computed"""
+    return {month: mode for month, mode in execute(db, _quantiles).fetchall()}
+
+
+# Legs with at most this many legs per cell are sent for a viewport with a zoom level
+LEGS_PER_CELL = 8
+# Cells are 4 x 4 in each map tile of 256 x 256 pixels
+_cells_per_tile_zoom = 2
+
+
+@dataclass(frozen=True)
+class Viewport:
+    """The part of the map that is visible, in degrees, and the zoom level of the map
+
+    Legs are in the viewport when they start in it. With a zoom level, legs are limited to
+    the LEGS_PER_CELL most interesting in each cell of a grid with 64 x 64 pixel cells.
+    """
+
+    west: float
+    south: float
+    east: float
+    north: float
+    zoom: int | None = None
+
+    @property
+    def cell_shift(self) -> int | None:
+        """How far to shift a tile key right to get the cell it is in, None without zoom"""
+        if self.zoom is None:
+            return None
+        cell_zoom = min(max(self.zoom, 0) + _cells_per_tile_zoom, GRID_ZOOM)
+        return 2 * (GRID_ZOOM - cell_zoom)
+
+    @property
+    def per_cell(self) -> int | None:
+        return None if self.zoom is None else LEGS_PER_CELL
+
+    def params(self) -> dict[str, object]:
+        return dict(
+            west=self.west,
+            south=self.south,
+            east=self.east,
+            north=self.north,
+            cell_shift=self.cell_shift,
+            per_cell=self.per_cell,
+        )
+
+
+_in_view = """
+  AND from_lon between $west and $east AND from_lat between $south and $north"""
+
+# Legs of $line_ref in $data_source, from the line_leg table that is sorted by line. Queries
+# have separate statements with and without it, since a catch-all ($line_ref is null OR ...)
+# keeps DuckDB from pushing the filter down
+_of_line = """
+  AND (dataSource, from_stop, to_stop) in (
+    FROM line_leg SELECT dataSource, from_stop, to_stop
+    WHERE dataSource = $data_source AND lineRef = $line_ref
+  )"""
+
+# Legs in the same cell rank by {rank}
+_top_per_cell = """
+QUALIFY $per_cell is null OR dense_rank() over (
+  partition by {tile} >> $cell_shift order by {rank} desc, dataSource, from_stop, to_stop
+) <= $per_cell"""
+
+_legs_query = """
+SELECT
   from_stop || ' to ' || to_stop as name,
   from_stop,
   to_stop,
@@ -71,24 +221,300 @@ SELECT distinct on (from_stop, to_stop, dataSource)
   monthly_count,
   hourly_count,
   dataSource as data_source,
-FROM leg_stats JOIN stop_line USING (dataSource, from_stop, to_stop)
-WHERE month = $month and hour = $hour and dataSource = $data_source AND ($line_ref is null OR $line_ref = stop_line.lineRef)
-    """,
-            params=dict(
-                month=month, hour=hour, data_source=data_source, line_ref=line_ref
-            ),
-        )
+FROM leg_stats
+WHERE month = $month and hour = $hour and dataSource = $data_source{of_line}{in_view}
+{top_per_cell}
+"""
+
+# By (of_line, in_view)
+_legs = {
+    (of_line, in_view): _statement(
+        "legs" + ("_of_line" if of_line else "") + ("_in_view" if in_view else ""),
+        _legs_query.format(
+            of_line=_of_line if of_line else "",
+            in_view=_in_view if in_view else "",
+            top_per_cell=_top_per_cell.format(tile="tile", rank="rush_intensity")
+            if in_view
+            else "",
+        ),
+    )
+    for of_line in (False, True)
+    for in_view in (False, True)
+}
+
+
+def legs(
+    db: DuckDBPyConnection,
+    month: date,
+    hour: int,
+    data_source: str,
+    line_ref: str | None = None,
+    viewport: Viewport | None = None,
+) -> "pd.DataFrame":
+    params: dict[str, object] = dict(month=month, hour=hour, data_source=data_source)
+    if line_ref is not None:
+        params.update(line_ref=line_ref)
+    if viewport is not None:
+        params.update(viewport.params())
+    return (
+        execute(db, _legs[line_ref is not None, viewport is not None], **params)
         .df()
         .sort_values(by="rush_intensity", ascending=True)
     )
 
 
-def hot_spots(
-    db: DuckDBPyConnection, month: date, hour: int, limit: int = 1000
-) -> pd.DataFrame:
-    return (
-        db.sql(
-            """
+_hourly_metrics = [
+    "rush_intensity",
+    "hourly_quartile",
+    "hourly_duration",
+    "hourly_delay",
+    "hourly_deviation",
+    "mean_hourly_duration",
+    "hourly_count",
+]
+
+_legs_by_hour_query = (
+    """
+with legs as (
+  FROM leg_stats
+  SELECT
+    dataSource,
+    from_stop,
+    to_stop,
+    any_value(air_distance_meters) as air_distance_meters,
+    any_value(from_lat) as from_lat,
+    any_value(from_lon) as from_lon,
+    any_value(to_lat) as to_lat,
+    any_value(to_lon) as to_lon,
+    any_value(monthly_duration) as monthly_duration,
+    any_value(monthly_delay) as monthly_delay,
+    any_value(monthly_deviation) as monthly_deviation,
+    any_value(mean_monthly_duration) as mean_monthly_duration,
+    any_value(monthly_count) as monthly_count,
+    -- One list of structs keeps the metrics of each hour together without sorting
+    list({{
+      'hour': hour :: int4,
+      'rush_intensity': round(hourly_quartile / monthly_duration, 1),
+      'hourly_quartile': hourly_quartile,
+      'hourly_duration': hourly_duration,
+      'hourly_delay': hourly_delay,
+      'hourly_deviation': hourly_deviation,
+      'mean_hourly_duration': mean_hourly_duration,
+      'hourly_count': hourly_count
+    }}) as by_hour
+  WHERE month = $month and dataSource = $data_source{of_line}
+  GROUP BY dataSource, from_stop, to_stop
+), hours as (
+  FROM legs SELECT *, list_transform(by_hour, item -> item.hour) as hours
+)
+FROM hours
+SELECT
+  from_stop || ' to ' || to_stop as name,
+  from_stop,
+  to_stop,
+  air_distance_meters,
+  from_lat,
+  from_lon,
+  to_lat,
+  to_lon,
+  from_lat * .985 + to_lat * .015 as lat,
+  from_lon * .985 + to_lon * .015 as lon,
+  monthly_duration,
+  monthly_delay,
+  monthly_deviation,
+  mean_monthly_duration,
+  monthly_count,
+  dataSource as data_source,
+"""
+    + ",\n".join(
+        f"  list_transform(range(24), h -> by_hour[list_position(hours, h)].{metric}) as {metric}"
+        for metric in _hourly_metrics
+    )
+    + """
+ORDER BY from_stop, to_stop
+"""
+)
+_legs_by_hour = _statement("legs_by_hour", _legs_by_hour_query.format(of_line=""))
+_legs_of_line_by_hour = _statement(
+    "legs_of_line_by_hour", _legs_by_hour_query.format(of_line=_of_line)
+)
+
+
+def legs_by_hour(
+    db: DuckDBPyConnection,
+    month: date,
+    data_source: str,
+    line_ref: str | None = None,
+) -> pa.Table:
+    """Legs of data_source in month, with each hourly metric as a list indexed by hour
+
+    Hours without enough data for a leg are null.
+    """
+    if line_ref is None:
+        result = execute(db, _legs_by_hour, month=month, data_source=data_source)
+    else:
+        result = execute(
+            db,
+            _legs_of_line_by_hour,
+            month=month,
+            data_source=data_source,
+            line_ref=line_ref,
+        )
+    return result.to_arrow_table()
+
+
+_leg_history = _statement(
+    "leg_history",
+    """
+FROM leg_history
+SELECT
+  month :: date as month,
+  hour :: int4 as hour,
+  round(hourly_quartile / monthly_duration, 1) as rush_intensity,
+  hourly_quartile,
+  hourly_duration,
+  monthly_duration,
+  monthly_delay,
+  hourly_delay,
+  monthly_deviation,
+  hourly_deviation,
+  mean_hourly_duration,
+  mean_monthly_duration,
+  monthly_count,
+  hourly_count
+WHERE dataSource = $data_source AND from_stop = $from_stop AND to_stop = $to_stop
+ORDER BY month, hour
+""",
+)
+
+
+def leg_history(
+    db: DuckDBPyConnection, data_source: str, from_stop: str, to_stop: str
+) -> pa.Table:
+    """Stats of one leg for every month and hour, from the leg_history table"""
+    return execute(
+        db, _leg_history, data_source=data_source, from_stop=from_stop, to_stop=to_stop
+    ).to_arrow_table()
+
+
+_travel_time = _statement(
+    "travel_time",
+    """
+FROM line_travel_time a JOIN line_travel_time b USING (dataSource, lineRef, direction, month, hour)
+SELECT
+  direction,
+  b.position - a.position as legs,
+  b.duration - a.duration as duration,
+  b.quartile - a.quartile as quartile
+WHERE dataSource = $data_source AND lineRef = $line_ref AND month = $month AND hour = $hour
+  AND a.stop = $from_stop AND b.stop = $to_stop
+  AND a.position < b.position AND a.missing_legs = b.missing_legs
+ORDER BY legs
+LIMIT 1
+""",
+)
+
+
+def travel_time(
+    db: DuckDBPyConnection,
+    month: date,
+    hour: int,
+    data_source: str,
+    line_ref: str,
+    from_stop: str,
+    to_stop: str,
+) -> dict[str, object] | None:
+    """Typical and 75th percentile seconds from from_stop to to_stop on line_ref
+
+    These are sums of the leg statistics along the line, see etl.mkdb._line_travel_time.
+    None if the line does not go from from_stop to to_stop, or lacks stats for a leg between.
+    """
+    result = execute(
+        db,
+        _travel_time,
+        month=month,
+        hour=hour,
+        data_source=data_source,
+        line_ref=line_ref,
+        from_stop=from_stop,
+        to_stop=to_stop,
+    )
+    row = result.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in result.description], row))
+
+
+_export_leg_stats = _statement(
+    "export_leg_stats",
+    """
+FROM leg_stats
+SELECT * EXCLUDE (tile)
+WHERE month :: date BETWEEN date_trunc('month', $start :: date) AND $end :: date
+  AND ($data_source is null OR dataSource = $data_source)
+  AND ($line_ref is null OR (dataSource, from_stop, to_stop) in (
+    FROM line_leg SELECT dataSource, from_stop, to_stop WHERE lineRef = $line_ref
+  ))
+""",
+)
+
+
+def export_leg_stats(
+    db: DuckDBPyConnection,
+    start: date,
+    end: date,
+    data_source: str | None = None,
+    line_ref: str | None = None,
+    batch_size: int = 65536,
+) -> pa.RecordBatchReader:
+    """leg_stats for the months from start to end
+
+    Rows are not sorted, so the first batch is ready without reading the whole range.
+    """
+    return execute(
+        db,
+        _export_leg_stats,
+        start=start,
+        end=end,
+        data_source=data_source,
+        line_ref=line_ref,
+    ).to_arrow_reader(batch_size)
+
+
+_export_legs = _statement(
+    "export_legs",
+    """
+FROM read_parquet($legs, hive_partitioning=true)
+SELECT *
+WHERE operatingDate BETWEEN $start :: date AND $end :: date
+  AND ($data_source is null OR dataSource = $data_source)
+  AND ($line_ref is null OR lineRef = $line_ref)
+""",
+)
+
+
+def export_legs(
+    db: DuckDBPyConnection,
+    legs: str,
+    start: date,
+    end: date,
+    data_source: str | None = None,
+    line_ref: str | None = None,
+    batch_size: int = 65536,
+) -> pa.RecordBatchReader:
+    """Rows of the legs parquet dataset at legs from start to end, unsorted like export_leg_stats"""
+    return execute(
+        db,
+        _export_legs,
+        legs=legs,
+        start=start,
+        end=end,
+        data_source=data_source,
+        line_ref=line_ref,
+    ).to_arrow_reader(batch_size)
+
+
+_hot_spots_query = """
     SELECT distinct on (from_stop, to_stop, dataSource)
       from_stop || ' to ' || to_stop as name,
       from_stop,
@@ -114,64 +540,108 @@ def hot_spots(
       hourly_count,
       dataSource as data_source
     FROM leg_stats
-    WHERE month = $month and hour = $hour
+    WHERE month = $month and hour = $hour{in_view}
+    {top_per_cell}
     ORDER BY rush_intensity DESC
     LIMIT $limit
-        """,
-            params=dict(month=month, hour=hour, limit=limit),
+        """
+
+_hot_spots = _statement(
+    "hot_spots", _hot_spots_query.format(in_view="", top_per_cell="")
+)
+_hot_spots_in_view = _statement(
+    "hot_spots_in_view",
+    _hot_spots_query.format(
+        in_view=_in_view,
+        top_per_cell=_top_per_cell.format(tile="tile", rank="rush_intensity"),
+    ),
+)
+
+
+def hot_spots(
+    db: DuckDBPyConnection,
+    month: date,
+    hour: int,
+    limit: int = 1000,
+    viewport: Viewport | None = None,
+) -> "pd.DataFrame":
+    params = dict(month=month, hour=hour, limit=limit)
+    return (
+        (
+            execute(db, _hot_spots, **params)
+            if viewport is None
+            else execute(db, _hot_spots_in_view, **params, **viewport.params())
         )
         .df()
         .sort_values(by="rush_intensity", ascending=True)
     )
 
 
+_total_transports = _statement(
+    "total_transports", "select sum(hourly_count) as count from leg_stats"
+)
+
+
 def total_transports(db: DuckDBPyConnection) -> int:
-    r = db.sql("select sum(hourly_count) as count from leg_stats").fetchall()
+    r = execute(db, _total_transports).fetchall()
     return r[0][0]
 
 
-def min_max_date(db: DuckDBPyConnection) -> tuple[date, date]:
-    r = db.sql(
-        """
+_min_max_date = _statement(
+    "min_max_date",
+    """
     select min_date, max_date
     from arrivals_stats
-    """
-    ).fetchall()
+    """,
+)
+
+
+def min_max_date(db: DuckDBPyConnection) -> tuple[date, date]:
+    r = execute(db, _min_max_date).fetchall()
     return tuple(r[0])
 
 
-def total_arrivals(db: DuckDBPyConnection) -> int | None:
-    try:
-        r = db.sql(
-            """
+_total_arrivals = _statement(
+    "total_arrivals",
+    """
             select total_arrivals
             from arrivals_stats
-        """
-        ).fetchall()
+        """,
+)
+
+
+def total_arrivals(db: DuckDBPyConnection) -> int | None:
+    try:
+        r = execute(db, _total_arrivals).fetchall()
         return r[0][0]
     except Exception:
         return None
 
 
+_leg_stat_count = _statement("leg_stat_count", "select count(*) from leg_stats")
+
+
 def leg_stat_count(db: DuckDBPyConnection) -> int:
-    return db.sql("select count(*) from leg_stats").fetchall()[0][0]
+    return execute(db, _leg_stat_count).fetchall()[0][0]
+
+
+_duckdb_memory = _statement(
+    "duckdb_memory", "select sum(memory_usage_bytes) from duckdb_memory();"
+)
 
 
 def duckdb_memory(db: DuckDBPyConnection) -> int:
-    return db.sql("select sum(memory_usage_bytes) from duckdb_memory();").fetchall()[0][
-        0
-    ]
+    return execute(db, _duckdb_memory).fetchall()[0][0]
 
 
 _comparisons = """
 with prev as (
   from leg_stats where hour = $hour and month = $prev_month
 ), cur as (
-  from leg_stats where hour = $hour and month = $cur_month
+  from leg_stats where hour = $hour and month = $cur_month{of_line}{in_view}
 )
 from prev join cur using(dataSource, from_stop, to_stop)
-    join stop_line using(dataSource, from_stop, to_stop)
-select distinct on (from_stop, to_stop, dataSource)
+select
   from_stop || ' to ' || to_stop as name,
   cur.mean_hourly_duration - prev.mean_hourly_duration as net_change_seconds,
   (100 * (net_change_seconds :: int4) / 
@@ -204,10 +674,39 @@ select distinct on (from_stop, to_stop, dataSource)
   abs(net_change_proportion) as abs_net_change_proportion
 where cur.month != prev.month
   and ($data_source is null or $data_source = dataSource)
-  and ($line_ref is null OR $line_ref = stop_line.lineRef)
+{top_per_cell}
 order by abs_net_change_proportion desc
 """
 
+# Lines belong to one data source, so a line filter does not need $data_source
+_comparisons_of_line = """
+  AND (dataSource, from_stop, to_stop) in (
+    FROM line_leg SELECT dataSource, from_stop, to_stop WHERE lineRef = $line_ref
+  )"""
+
+# By (top, of_line, in_view), top ones are limited to $limit
+_comparison_statements = {
+    (top, of_line, in_view): _statement(
+        ("top" if top else "all")
+        + "_comparisons"
+        + ("_of_line" if of_line else "")
+        + ("_in_view" if in_view else ""),
+        _comparisons.format(
+            of_line=_comparisons_of_line if of_line else "",
+            in_view=_in_view if in_view else "",
+            top_per_cell=_top_per_cell.format(
+                tile="cur.tile", rank="abs_net_change_proportion"
+            )
+            if in_view
+            else "",
+        )
+        + ("limit $limit" if top else ""),
+    )
+    for top in (False, True)
+    for of_line in (False, True)
+    for in_view in (False, True)
+}
+
 
 def comparisons(
     db: DuckDBPyConnection,
@@ -217,19 +716,25 @@ def comparisons(
     limit: int = 2000,
     data_source: str | None = None,
     line_ref: str | None = None,
-) -> pd.DataFrame:
-    params = dict(
+    viewport: Viewport | None = None,
+) -> "pd.DataFrame":
+    params: dict[str, object] = dict(
         prev_month=prev_month,
         cur_month=cur_month,
         hour=hour,
         data_source=data_source,
-        line_ref=line_ref,
     )
+    if line_ref is not None:
+        params.update(line_ref=line_ref)
+    if viewport is not None:
+        params.update(viewport.params())
+    # Without a data source to narrow them down, only the top legs are sent
+    top = data_source is None
+    if top:
+        params.update(limit=limit)
+    statement = _comparison_statements[top, line_ref is not None, viewport is not None]
     return (
-        db.sql(
-            _comparisons + ("limit $limit;" if data_source is None else ";"),
-            params={"limit": limit, **params} if data_source is None else params,
-        )
+        execute(db, statement, **params)
         .df()
         .sort_values(by="abs_net_change_proportion")
     )
@@ -0,0 +1,193 @@
+"""
+Find stops near a point or by name, from the stop table exported by etl.mkdb
+
+Everything is in memory in plain Python, so lookups do not touch DuckDB.
+"""
+
+import bisect
+import math
+from collections import defaultdict
+from os.path import join
+
+import numpy as np
+import pyarrow as pa
+
+from .etl.columnar import STOPS
+
+# Grid cells are this many degrees of latitude high, and twice as many degrees of longitude
+# wide, which makes them about square in southern Norway
+CELL_DEGREES = 0.01
+_EARTH_RADIUS_METERS = 6371008.8
+
+
+def distance_meters(lat: float, lon: float, to_lat: float, to_lon: float) -> float:
+    # Equirectangular, which is plenty accurate at the distances between stops
+    x = math.radians(to_lon - lon) * math.cos(math.radians((lat + to_lat) / 2))
+    y = math.radians(to_lat - lat)
+    return _EARTH_RADIUS_METERS * math.hypot(x, y)
+
+
+def _distances_meters(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray):
+    x = np.radians(lons - lon) * np.cos(np.radians((lats + lat) / 2))
+    y = np.radians(lats - lat)
+    return _EARTH_RADIUS_METERS * np.hypot(x, y)
+
+
+def _cell(lat: float, lon: float) -> tuple[int, int]:
+    return math.floor(lat / CELL_DEGREES), math.floor(lon / (2 * CELL_DEGREES))
+
+
+def _words(folded: str) -> list[str]:
+    """What follows each space or punctuation in a case folded name"""
+    return [
+        folded[i + 1 :]
+        for i, char in enumerate(folded[:-1])
+        if not char.isalnum() and folded[i + 1].isalnum()
+    ]
+
+
+class StopIndex:
+    def __init__(self, names: list[str], lats: list[float], lons: list[float]):
+        self.names = names
+        self.lats = lats
+        self.lons = lons
+        grid: dict[tuple[int, int], list[int]] = defaultdict(list)
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            grid[_cell(lat, lon)].append(i)
+        self._grid = dict(grid)
+        self._lat_array = np.array(lats, dtype=np.float64)
+        self._lon_array = np.array(lons, dtype=np.float64)
+        # Cells are at least this many meters high and wide, they narrow towards the poles
+        northernmost = max((abs(lat) for lat in lats), default=0)
+        self._cell_meters = min(
+            math.radians(CELL_DEGREES),
+            math.radians(2 * CELL_DEGREES) * math.cos(math.radians(northernmost)),
+        ) * _EARTH_RADIUS_METERS
+        self._lat_range = (
+            min((lat for lat, _ in self._grid), default=0),
+            max((lat for lat, _ in self._grid), default=0),
+        )
+        self._lon_range = (
+            min((lon for _, lon in self._grid), default=0),
+            max((lon for _, lon in self._grid), default=0),
+        )
+        # Sorted case folded names, and sorted words within names, for prefix searches
+        folded = sorted((name.casefold(), i) for i, name in enumerate(names))
+        self._folded = [name for name, _ in folded]
+        self._folded_stops = [i for _, i in folded]
+        words = sorted((word, i) for name, i in folded for word in _words(name))
+        self._words = [word for word, _ in words]
+        self._word_stops = [i for _, i in words]
+
+    @classmethod
+    def load(cls, location: str) -> "StopIndex":
+        table = pa.ipc.open_file(pa.memory_map(join(location, STOPS))).read_all()
+        return cls(
+            table["name"].to_pylist(), table["lat"].to_pylist(), table["lon"].to_pylist()
+        )
+
+    def _stop(self, i: int) -> dict[str, object]:
+        return dict(name=self.names[i], lat=self.lats[i], lon=self.lons[i])
+
+    def _ring(self, center: tuple[int, int], radius: int) -> list[tuple[int, int]]:
+        lat, lon = center
+        if radius == 0:
+            return [center]
+        top = [(lat + radius, lon + d) for d in range(-radius, radius + 1)]
+        bottom = [(lat - radius, lon + d) for d in range(-radius, radius + 1)]
+        sides = [
+            (lat + d, lon + side)
+            for d in range(-radius + 1, radius)
+            for side in (-radius, radius)
+        ]
+        return top + bottom + sides
+
+    def _to_grid(self, center: tuple[int, int]) -> int:
+        """Rings closer than this to center are outside the grid, and have no stops"""
+        lat, lon = center
+        return max(
+            0,
+            self._lat_range[0] - lat,
+            lat - self._lat_range[1],
+            self._lon_range[0] - lon,
+            lon - self._lon_range[1],
+        )
+
+    def _beyond_grid(self, center: tuple[int, int], radius: int) -> bool:
+        lat, lon = center
+        return (
+            lat - radius < self._lat_range[0]
+            and lat + radius > self._lat_range[1]
+            and lon - radius < self._lon_range[0]
+            and lon + radius > self._lon_range[1]
+        )
+
+    def nearest(self, lat: float, lon: float, k: int = 10) -> list[dict[str, object]]:
+        """The k stops closest to lat, lon with their distance in meters, closest first
+
+        Searches rings of cells around the point, until the ring is further away than
+        the kth closest stop found so far. Far from any stop, where the rings cover more
+        cells than the grid has, it measures the distance to every stop instead.
+        """
+        center = _cell(lat, lon)
+        found: list[tuple[float, int]] = []
+        radius = self._to_grid(center)
+        while k > 0 and self._grid:
+            # Rings up to radius cover (2 * radius + 1) ** 2 cells
+            if (2 * radius + 1) ** 2 > len(self._grid):
+                return self._nearest_of_all(lat, lon, k)
+            for cell in self._ring(center, radius):
+                for i in self._grid.get(cell, ()):
+                    found.append(
+                        (distance_meters(lat, lon, self.lats[i], self.lons[i]), i)
+                    )
+            found.sort()
+            del found[k:]
+            # Stops outside the rings searched so far are at least radius cells away
+            ring_distance = radius * self._cell_meters
+            if (len(found) == k and found[-1][0] <= ring_distance) or self._beyond_grid(
+                center, radius
+            ):
+                break
+            radius += 1
+        return [
+            dict(self._stop(i), distance_meters=round(distance))
+            for distance, i in found
+        ]
+
+    def _nearest_of_all(self, lat: float, lon: float, k: int) -> list[dict[str, object]]:
+        distances = _distances_meters(lat, lon, self._lat_array, self._lon_array)
+        closest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else None
+        order = (
+            closest[np.argsort(distances[closest])]
+            if closest is not None
+            else np.argsort(distances)
+        )
+        return [
+            dict(self._stop(int(i)), distance_meters=round(float(distances[i])))
+            for i in order
+        ]
+
+    def search(self, prefix: str, limit: int = 10) -> list[dict[str, object]]:
+        """Stops with a name or a word of the name starting with prefix, ignoring case
+
+        Names that start with the prefix are listed before those that only have a word
+        starting with it.
+        """
+        query = prefix.casefold()
+        if not query or limit <= 0:
+            return []
+        found: list[int] = []
+        seen: set[int] = set()
+        for keys, stops in (
+            (self._folded, self._folded_stops),
+            (self._words, self._word_stops),
+        ):
+            for j in range(bisect.bisect_left(keys, query), len(keys)):
+                if len(found) >= limit or not keys[j].startswith(query):
+                    break
+                i = stops[j]
+                if i not in seen:
+                    seen.add(i)
+                    found.append(i)
+        return [self._stop(i) for i in found]
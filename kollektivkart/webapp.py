@@ -1,30 +1,220 @@
+import logging
 import os
+import tempfile
+import threading
+import time
 
 import flask
 import duckdb
-from flask import g, jsonify
+from duckdb import DuckDBPyConnection
+from flask import g, jsonify, request, Response
 
-from . import api
+from . import api, compression, metrics, queries
+from .columnar import ColumnarStore
+from .etl.columnar import STOPS
+from .export import ExportCache
+from .stops import StopIndex
 
 root = os.environ.get("PARQUET_LOCATION", "data")
-db = duckdb.connect(os.path.join(root, "stats.db"), read_only=True)
-db.execute("set threads = 2;")
-db.execute("set memory_limit = '512MB';")
+serving = os.path.join(root, "serving")
+columnar_serving = os.environ.get("COLUMNAR_SERVING", "true") == "true"
+exports = ExportCache(
+    root,
+    os.environ.get(
+        "EXPORT_CACHE", os.path.join(tempfile.gettempdir(), "kollektivkart-exports")
+    ),
+    int(os.environ.get("EXPORT_CACHE_MB", "2048")) * 1024 * 1024,
+)
+
+# Compressed responses, in each worker
+responses = compression.ResponseCache(
+    int(os.environ.get("RESPONSE_CACHE_MB", "64")) * 1024 * 1024
+)
+
+
+# Threads of each DuckDB connection, and of the thread pool that runs requests in asgi
+threads = int(os.environ.get("DUCKDB_THREADS", "2"))
+
+
+def open_db() -> DuckDBPyConnection:
+    db = duckdb.connect(os.path.join(root, "stats.db"), read_only=True)
+    db.execute(f"set threads = {threads};")
+    db.execute("set memory_limit = '512MB';")
+    return db
+
+
+class CursorPool:
+    """Long-lived cursors for db, so statements prepared by queries.execute are reused
+
+    Each process has a pool of its own, see worker.
+    """
+
+    def __init__(self, db: DuckDBPyConnection):
+        self._db = db
+        self._idle: list[DuckDBPyConnection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> DuckDBPyConnection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._db.cursor()
+
+    def release(self, cursor: DuckDBPyConnection):
+        with self._lock:
+            self._idle.append(cursor)
+
+
+class Worker:
+    """What this process serves: its cursors on stats.db, the data versions read from them,
+    and the serving files next to it
+
+    They are all opened at the same time, after the fork, so a worker that replaces one
+    that exited after an ETL run serves the new data under its new versions. The serving
+    files are memory-mapped, so workers still share their pages through the OS page cache.
+    """
+
+    def __init__(self, db: DuckDBPyConnection):
+        self.cursors = CursorPool(db)
+        self.versions = api.revised(queries.data_versions(db))
+        self.store = (
+            ColumnarStore(serving)
+            if columnar_serving and os.path.isdir(serving)
+            else None
+        )
+        self.stops = (
+            StopIndex.load(serving)
+            if os.path.exists(os.path.join(serving, STOPS))
+            else None
+        )
+
+
+_lock = threading.Lock()
+_worker: Worker | None = None
+_worker_pid: int | None = None
+_warming_pid: int | None = None
+# Cleared while this process is warming up, see start_warming
+warmed = threading.Event()
+warmed.set()
+
+
+def worker() -> Worker:
+    """The Worker of this process, it is opened on first use after a fork"""
+    global _worker, _worker_pid
+    if _worker is not None and _worker_pid == os.getpid():
+        return _worker
+    with _lock:
+        if _worker is None or _worker_pid != os.getpid():
+            _worker, _worker_pid = Worker(open_db()), os.getpid()
+        return _worker
+
+
+def start_warming():
+    """Open the Worker of this process and warm up in the background
+
+    gunicorn_conf does this as soon as a worker forks, instead of on its first request, and
+    asgi on startup. Only the first call in each process does anything.
+    """
+    global _warming_pid
+    worker()
+    with _lock:
+        if _warming_pid == os.getpid():
+            return
+        _warming_pid = os.getpid()
+    warmed.clear()
+    threading.Thread(target=warm, name="warm", daemon=True).start()
+
+
+def warm_urls() -> list[str]:
+    """The hot spots and comparisons of the latest month, which is what the map opens with"""
+    months = sorted(month for month in worker().versions if month is not None)
+    urls = ["/api/partitions", "/api/datasource-names"]
+    if not months:
+        return urls
+    cur = months[-1]
+    urls.extend(f"/api/hot-spots/{cur.year}/{cur.month}/{hour}" for hour in range(24))
+    if len(months) > 1:
+        prev = months[-2]
+        urls.extend(
+            f"/api/comparison/{cur.year}/{cur.month}/{prev.year}/{prev.month}/{hour}"
+            for hour in range(24)
+        )
+    return urls
+
+
+def warm():
+    """Request warm_urls, so their statements are prepared and their pages are loaded"""
+    started = time.perf_counter()
+    try:
+        client = server.test_client()
+        urls = warm_urls()
+        for url in urls:
+            client.get(url)
+        logging.info(
+            "Warmed up %d urls in %.2fs", len(urls), time.perf_counter() - started
+        )
+    except Exception:
+        logging.exception("Failed to warm up")
+    finally:
+        warmed.set()
+
+
 server = flask.Flask(__name__)
 server.register_blueprint(api.app, url_prefix="/api")
+server.register_blueprint(
+    api.app, url_prefix="/api/v/<version>", name="versioned_api"
+)
+
+
+@server.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    metrics.in_flight.add(1)
 
 
 @server.before_request
 def connect_db():
-    g.db = db.cursor()
+    state = worker()
+    g.db = state.cursors.acquire()
+    g.store = state.store
+    g.stops = state.stops
+    g.exports = exports
+    g.responses = responses
+    g.versions = state.versions
 
 
 @server.after_request
-def close_db(r):
-    g.db.close()
-    return r
+def observe_request(response: Response) -> Response:
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.request_seconds.observe(
+        time.perf_counter() - g.started, route, str(response.status_code)
+    )
+    if not response.is_streamed:
+        metrics.response_bytes.observe(response.calculate_content_length() or 0, route)
+    return response
+
+
+@server.teardown_request
+def close_db(_exc: BaseException | None):
+    if "db" in g:
+        worker().cursors.release(g.pop("db"))
+    if "started" in g:
+        metrics.in_flight.add(-1)
 
 
 @server.get("/ready")
 def ready():
+    if not warmed.is_set():
+        return jsonify(dict(state="warming")), 503
     return jsonify(dict(state="up"))
+
+
+@server.get("/metrics")
+def prometheus_metrics():
+    metrics.duckdb_memory.set(queries.duckdb_memory(g.db) or 0)
+    return Response(metrics.expose(), content_type="text/plain; version=0.0.4")
+
+
+@server.get("/slow-queries")
+def slow_queries():
+    return jsonify(metrics.slow_queries.slowest())
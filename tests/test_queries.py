@@ -0,0 +1,32 @@
+import unittest
+from datetime import date
+
+import duckdb
+
+from kollektivkart import queries
+
+
+class LiteralTest(unittest.TestCase):
+    def test_quotes_are_escaped(self):
+        db = duckdb.connect()
+        literal = queries._literal("it's")
+        self.assertEqual(db.sql(f"select {literal}").fetchone(), ("it's",))
+
+    def test_dates_and_numbers(self):
+        self.assertEqual(queries._literal(date(2025, 3, 1)), "DATE '2025-03-01'")
+        self.assertEqual(queries._literal(1.5), "1.5")
+        self.assertEqual(queries._literal(None), "NULL")
+
+    def test_non_finite_numbers_are_invalid(self):
+        for value in (float("nan"), float("inf"), float("-inf")):
+            with self.assertRaises(queries.InvalidParameter):
+                queries._literal(value)
+
+    def test_nul_bytes_are_invalid(self):
+        for value in ("a\x00", "a\x00b"):
+            with self.assertRaises(queries.InvalidParameter):
+                queries._literal(value)
+
+
+if __name__ == "__main__":
+    unittest.main()